@@ -6,79 +6,36 @@ CIP Performance Monitoring & Analytics
 - No additional libraries required
 """
 
+import os
+import time
 import streamlit as st
 import pandas as pd
-import requests
+import numpy as np
 from requests.auth import HTTPBasicAuth   # ← restored to original
 from datetime import datetime, timedelta
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import urllib3
-import concurrent.futures
-import time
-import pickle
-import os
-import hashlib
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from cip_analysis import (score_cycles, build_cycle_indexes, CycleTable, CycleTracker, pass_rates,
+                          ANALYSIS_WORKERS, MIN_DURATION)
+from cip_data import (FACTORY_CONFIG, DISK_INDEX, init_cache, SHARED_FRAMES, PI_ASYNC_INFLIGHT, PIClient, AsyncPIClient,
+                      pi_event_loop, fetch_batch, analyse_plant, pi_traffic, load_window, load_days,
+                      load_precomputed, drop_precomputed, time_slice, downsample, fetch_plot, LiveFeed, LIVE_POLL_SEC)
+from cip_metrics import METRICS, serve_prometheus
 
 st.set_page_config(page_title="CIP Monitoring & Analytics Pro", layout="wide")
 
-FACTORY_CONFIG = {
-    "PK1": {
-        "tags": {
-            "R421": "BEB1-10-0400A-TI421", "R422": "BEB1-10-0400A-TI422",
-            "R423": "BEB1-10-0400A-TI423", "R424B": "BEB1-10-0400A-TI424B",
-            "R424": "BEB1-10-0400A-TI424", "R425": "BEB1-10-0400A-TI425",
-            "R426": "BEB1-10-0400A-TI426"
-        },
-        "cip_tag": None
-    },
-    "PK2": {
-        "tags": {
-            "R421": "BEB1-10-0400B-TT421", "R422": "BEB1-10-0400B-TT422",
-            "R423": "BEB1-10-0400B-TT423", "R423B": "BEB1-10-0400B-TT423B",
-            "R424": "BEB1-10-0400B-TT424", "R425": "BEB1-10-0400B-TT425",
-            "R426": "BEB1-10-0400B-TT426"
-        },
-        "cip_tag": None
-    },
-    "KN": {
-        "tags": {
-            "R421": "OEO1-10-0400-TT421", "R422": "OEO1-10-0400-TT422",
-            "R423": "OEO1-10-0400-TT423", "R424": "OEO1-10-0400-TT424",
-            "R425": "OEO1-10-0400-TT425", "R426": "OEO1-10-0400-TT426",
-            "R427": "OEO1-10-0400-TT427"
-        },
-        "cip_tag": None
-    },
-    "DC": {
-        "tags": {
-            "R421": "BEB3-10-0400-TT421", "R422": "BEB3-10-0400-TT422B",
-            "R423": "BEB3-10-0400-TT423B", "R424": "BEB3-10-0400-TT424B",
-            "R425": "BEB3-10-0400-TT425B", "R426": "BEB3-10-0400-TT426B",
-            "R427": "BEB3-10-0400-TT427B"
-        },
-        "cip_tag": "BEB3-57-0100-CIP"
-    },
-    "MCE": {
-        "tags": {
-            "R421": "CEC1-10-0400-TI421", "R422": "CEC1-10-0400-TI422",
-            "R423": "CEC1-10-0400-TI423", "R424": "CEC1-10-0400-TI424",
-            "R425": "CEC1-10-0400-TI425", "R426": "CEC1-10-0400-TI426"
-        },
-        "cip_tag": None
-    }
-}
-
-# Cache stored in same folder as script
-CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cip_cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
-CACHE_TTL_HOURS = 6
-
 if "results"      not in st.session_state: st.session_state.results      = {}
 if "view_history" not in st.session_state: st.session_state.view_history = None
 if "fetch_errors" not in st.session_state: st.session_state.fetch_errors = []
+if "cycles"       not in st.session_state: st.session_state.cycles       = None
+if "scored"       not in st.session_state: st.session_state.scored       = None
+if "rollups"      not in st.session_state: st.session_state.rollups      = {}
+if "scored_for"   not in st.session_state: st.session_state.scored_for   = None
+if "perf"         not in st.session_state: st.session_state.perf         = None
+if "live"         not in st.session_state: st.session_state.live         = None
+if "run_id"       not in st.session_state: st.session_state.run_id       = 0
+if "run_factory"  not in st.session_state: st.session_state.run_factory  = None
+if "figs"         not in st.session_state: st.session_state.figs         = {}
 
 st.markdown("""
     <style>
@@ -97,174 +54,35 @@ st.markdown("""
     </style>""", unsafe_allow_html=True)
 
 
-# ============================================================
-# DISK CACHE
-# ============================================================
-def _cache_key(tag, date_str):
-    return hashlib.md5(f"{tag}_{date_str}".encode()).hexdigest()
-
-def _load_cache(tag, date_str):
-    fpath = os.path.join(CACHE_DIR, f"{_cache_key(tag, date_str)}.pkl")
-    if not os.path.exists(fpath): return None
-    if (time.time() - os.path.getmtime(fpath)) / 3600 > CACHE_TTL_HOURS:
-        os.remove(fpath); return None
-    try:
-        with open(fpath, "rb") as f: return pickle.load(f)
-    except: return None
-
-def _save_cache(tag, date_str, df):
-    fpath = os.path.join(CACHE_DIR, f"{_cache_key(tag, date_str)}.pkl")
-    try:
-        with open(fpath, "wb") as f: pickle.dump(df, f)
-    except: pass
-
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_pi_client(user, pw, use_async=False):
+    """PIClient shared across reruns (and sessions) of the same login"""
+    if use_async: return AsyncPIClient(HTTPBasicAuth(user, pw), pi_event_loop())
+    return PIClient(HTTPBasicAuth(user, pw))   # ← same as original, no domain needed
 
-# ============================================================
-# PI FETCH — HTTPBasicAuth (same as original) + retry + cache
-# ============================================================
-PI_BASE = "https://piazu.mitrphol.com/piwebapi"
-
-def get_data_pi(tag_path, auth, start_time, end_time=None, max_retries=3):
-    if not tag_path:
-        return pd.DataFrame(columns=['Time', 'Val'])
-
-    date_str  = start_time.strftime("%Y-%m-%d") if hasattr(start_time, 'strftime') else str(start_time)
-    end_date_str = end_time.strftime("%Y-%m-%d") if end_time and hasattr(end_time, 'strftime') else "now"
-    date_str = f"{date_str}_to_{end_date_str}"
-    start_str = start_time.strftime("%Y-%m-%dT00:00:00Z") if hasattr(start_time, 'strftime') else f"{start_time}T00:00:00Z"
-    end_str   = end_time.strftime("%Y-%m-%dT23:59:59Z") if end_time and hasattr(end_time, 'strftime') else "*"
-
-    # check cache
-    cached = _load_cache(tag_path, date_str)
-    if cached is not None:
-        return cached
-
-    for attempt in range(1, max_retries + 1):
-        try:
-            r = requests.get(
-                f"{PI_BASE}/points",
-                params={"path": f"\\\\MPAZU-PIDCDB\\{tag_path}"},
-                auth=auth, verify=False, timeout=20
-            )
-            if r.status_code == 401:
-                raise ValueError("HTTP 401 — Incorrect Username or Password")
-            if r.status_code != 200:
-                raise ValueError(f"HTTP {r.status_code}")
-
-            webid = r.json()["WebId"]
-            r2 = requests.get(
-                f"{PI_BASE}/streams/{webid}/recorded",
-                params={"startTime": start_str, "endTime": end_str, "maxCount": 50000},
-                auth=auth, verify=False, timeout=45
-            )
-            items = r2.json().get("Items", [])
-            if not items:
-                df = pd.DataFrame(columns=['Time', 'Val'])
-                _save_cache(tag_path, date_str, df)
-                return df
-
-            df = pd.DataFrame(items)
-            df['Time'] = (pd.to_datetime(df['Timestamp'], format='ISO8601')
-                          .dt.tz_convert('Asia/Bangkok').dt.tz_localize(None))
-            df['Val'] = pd.to_numeric(
-                df['Value'].apply(lambda x: x.get('Value') if isinstance(x, dict) else x),
-                errors='coerce')
-            df = df[['Time', 'Val']].dropna().sort_values('Time')
-            _save_cache(tag_path, date_str, df)
-            return df
-
-        except Exception as e:
-            err = str(e)
-            if "401" in err:
-                # 401 → no retry — invalid credentials
-                return pd.DataFrame({'Time':[None],'Val':[None],'_error':[err],'_tag':[tag_path]})
-            if attempt < max_retries:
-                time.sleep(attempt * 2)
-            else:
-                return pd.DataFrame({'Time':[None],'Val':[None],'_error':[err],'_tag':[tag_path]})
 
-    return pd.DataFrame(columns=['Time', 'Val'])
+@st.cache_resource(show_spinner=False)
+def metrics_endpoint():
+    """Prometheus /metrics for the whole server process when CIP_METRICS_PORT is set"""
+    port = os.environ.get("CIP_METRICS_PORT")
+    return serve_prometheus(port) if port and METRICS.enabled else None
 
 
-def fetch_all_tags_parallel(tag_dict, auth, start_time, end_time=None, max_workers=5):
-    """Fetch all tanks in parallel"""
-    results, errors = {}, {}
-
-    def _one(item):
-        name, tag = item
-        return name, get_data_pi(tag, auth, start_time, end_time)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futs = {ex.submit(_one, it): it for it in tag_dict.items()}
-        for fut in concurrent.futures.as_completed(futs):
-            try:
-                name, df = fut.result()
-                if '_error' in df.columns and not df.empty:
-                    errors[name] = df['_error'].iloc[0]
-                    results[name] = pd.DataFrame(columns=['Time', 'Val'])
-                else:
-                    results[name] = df
-            except Exception as e:
-                n = futs[fut][0]; errors[n] = str(e)
-                results[n] = pd.DataFrame(columns=['Time', 'Val'])
-    return results, errors
+metrics_endpoint()
+init_cache()   # once per server process: migrate old cache files, start the sweeper
 
 
 # ============================================================
 # PROCESS LOGIC
 # ============================================================
-def process_logic(temp_df, conc_df, target_t, min_m):
-    history = []
-    TRIGGER_TEMP  = 40.0   # อุณหภูมิเริ่มนับว่าอาจเป็น CIP (°C)
-    MIN_DURATION  = 15.0   # ✅ ต้องสูงกว่า TRIGGER_TEMP ติดต่อกันอย่างน้อย 15 นาที
-                           #    จึงนับเป็น CIP cycle (กรองอุณหภูมิสูงชั่วคราว)
-    GAP_MIN       = 45     # ช่องว่างระหว่าง cycle ที่ถือว่ายังเป็น cycle เดียวกัน (นาที)
-
-    if temp_df.empty: return []
-
-    combined_df = (pd.merge_asof(temp_df.sort_values('Time'),
-                                 conc_df.sort_values('Time').rename(columns={'Val': 'Conc'}),
-                                 on='Time', direction='backward')
-                   if not conc_df.empty else temp_df.assign(Conc=0))
-
-    raw_p, active, s_t = [], False, None
-    for _, row in combined_df.iterrows():
-        if row['Val'] > TRIGGER_TEMP and not active: active, s_t = True, row['Time']
-        elif row['Val'] <= TRIGGER_TEMP and active:
-            raw_p.append({'Start': s_t, 'End': row['Time']}); active = False
-    if not raw_p: return []
-
-    merged, curr = [], raw_p[0]
-    for nxt in raw_p[1:]:
-        if (nxt['Start'] - curr['End']).total_seconds() / 60 <= GAP_MIN: curr['End'] = nxt['End']
-        else: merged.append(curr); curr = nxt
-    merged.append(curr)
-
-    for no, p in enumerate(merged, 1):
-        # ✅ กรองทิ้ง: อุณหภูมิสูงชั่วคราว < 15 นาที ไม่ถือเป็น CIP
-        if (p['End'] - p['Start']).total_seconds() / 60 < MIN_DURATION: continue
-
-        mask = (combined_df['Time'] >= p['Start']) & (combined_df['Time'] <= p['End'])
-        cyc  = combined_df.loc[mask].copy()
-        if len(cyc) < 2: continue
-        cyc  = cyc.set_index('Time').sort_index()
-        cyc  = cyc[~cyc.index.duplicated(keep='first')]
-        idx  = pd.date_range(start=p['Start'], end=p['End'], freq='10s')
-        rs   = cyc.reindex(cyc.index.union(idx)).interpolate('linear').reindex(idx)
-        acc  = (rs['Val'] >= target_t).sum() * (10 / 60)
-        above = rs[rs['Val'] >= target_t]
-        history.append({
-            "No": no, "Start": p['Start'], "End": p['End'],
-            "StartTime": p['Start'].strftime("%Y-%m-%d %H:%M"),
-            "TotalDuration": int(round((p['End'] - p['Start']).total_seconds() / 60)),
-            "TimeAboveTarget": int(round(acc)),
-            "MaxTemp": int(round(cyc['Val'].max())),
-            "AvgTemp": int(round(cyc['Val'].mean())),
-            "AvgTempTarget": int(round(above['Val'].mean() if not above.empty else 0)),
-            "AvgConc": round(cyc['Conc'].mean() if not cyc['Conc'].isna().all() else 0, 2),
-            "Status": "PASS" if acc >= min_m else "FAIL"
-        })
-    return history
+def rescore_results(target_t, min_m):
+    """Re-score the run's cycle table and its pass-rate rollups — no fetch, no interpolation"""
+    scored = st.session_state.cycles.score(target_t, min_m)
+    st.session_state.scored  = scored
+    st.session_state.rollups = {"tank":    pass_rates(scored, ["Factory", "Tank"]),
+                                "factory": pass_rates(scored, ["Factory"]),
+                                "month":   pass_rates(scored, ["Factory", "Month"])}
+    st.session_state.scored_for = (target_t, min_m)
 
 
 # ============================================================
@@ -277,6 +95,16 @@ with st.expander("📂 SYSTEM ACCESS & SETTINGS", expanded=True):
     with c1:
         user = st.text_input("Username", key="user")
         pw   = st.text_input("Password", type="password", key="pw")
+        batch_mode = st.checkbox("⚡ PI batch mode", value=False,
+                                 help="Send all WebId lookups and recorded reads as a few PI /batch calls")
+        proc_mode  = st.checkbox("🧮 Multi-process analysis", value=False,
+                                 help=f"Index large tanks on {ANALYSIS_WORKERS} worker processes")
+        async_mode = st.checkbox("🌀 Async fetch engine", value=False,
+                                 help=f"Run every tag fetch on one event loop (up to {PI_ASYNC_INFLIGHT} requests in flight)")
+        pre_mode   = st.checkbox("📦 Use precomputed results", value=True,
+                                 help="Load cycle histories stored by cip_precompute.py for this date range, if fresh")
+        live_mode  = st.checkbox("📡 Live mode", value=False,
+                                 help=f"Poll PI every {LIVE_POLL_SEC}s for the selected factory and track running cycles")
     with c2:
         factory_choice = st.selectbox("Select Factory",
             options=list(FACTORY_CONFIG.keys()) + ["Summary All Plant"], index=3)
@@ -286,14 +114,23 @@ with st.expander("📂 SYSTEM ACCESS & SETTINGS", expanded=True):
         s_dt  = st.date_input("Start Date", value=datetime(2026, 1, 1))
         e_dt  = st.date_input("End Date",   value=datetime.today())
 
-    b1, b2 = st.columns([3, 1])
+    # Clear Cache scope: everything, one factory (all its tags) or one tag
+    clear_scopes = {"All cache": None}
+    for f_name, f_conf in FACTORY_CONFIG.items():
+        tags = {**f_conf["tags"], "%CIP": f_conf["cip_tag"]}
+        clear_scopes[f"🏭 {f_name}"] = [t for t in tags.values() if t]
+        clear_scopes.update({f"🏷️ {f_name} / {k}": [t] for k, t in tags.items() if t})
+
+    b1, b2, b3 = st.columns([3, 1, 1])
     with b1: execute_btn     = st.button("🚀 EXECUTE ANALYTICS", use_container_width=True)
-    with b2: clear_cache_btn = st.button("🗑️ Clear Cache",       use_container_width=True)
+    with b2: clear_scope     = st.selectbox("Clear scope", list(clear_scopes), label_visibility="collapsed")
+    with b3: clear_cache_btn = st.button("🗑️ Clear Cache",       use_container_width=True)
 
 if clear_cache_btn:
-    n = sum(1 for f in os.listdir(CACHE_DIR)
-            if f.endswith(".pkl") and not os.remove(os.path.join(CACHE_DIR, f)))
-    st.success(f"✅ Cache cleared: {n} file(s)")
+    p = drop_precomputed(clear_scopes[clear_scope])   # stored cycles of the cleared tags go too
+    n = DISK_INDEX.remove(clear_scopes[clear_scope])
+    SHARED_FRAMES.clear(clear_scopes[clear_scope])
+    st.success(f"✅ Cache cleared ({clear_scope}): {n} file(s), {p} precomputed result(s)")
 
 
 # ============================================================
@@ -303,56 +140,89 @@ if execute_btn:
     if not user or not pw:
         st.error("Please enter Username and Password")
     else:
-        auth = HTTPBasicAuth(user, pw)   # ← same as original, no domain needed
+        client = get_pi_client(user, pw, async_mode)
         st.session_state.results      = {}
         st.session_state.view_history = None
         st.session_state.fetch_errors = []
-
+        st.session_state.cycles       = None
+        st.session_state.scored_for   = None
+        st.session_state.run_id      += 1
+        st.session_state.run_factory  = factory_choice   # the dashboard shows this run, not the dropdown
+        perf_mark = METRICS.mark()
+
+        summary   = factory_choice == "Summary All Plant"
+        factories = FACTORY_CONFIG if summary else {factory_choice: FACTORY_CONFIG[factory_choice]}
+        n_tanks   = sum(len(c["tags"]) for c in factories.values())
+        if summary: st.session_state.results = {"_is_summary": True}
+        cycle_index = {}
+
+        def _keep(f_name, tank, df_temp, df_conc, idx):
+            if not idx: return
+            cycle_index[(f_name, tank)] = idx
+            if not summary:
+                st.session_state.results[tank] = {"raw_temp": df_temp, "raw_conc": df_conc, "factory": f_name}
+
+        errs, pages, points = {}, 0, 0
+        analysis_workers = ANALYSIS_WORKERS if proc_mode else 1
+        label = (lambda f, t: f"{f}/{t}") if summary else (lambda f, t: t)
         with st.status("📊 Processing data...", expanded=True) as sb:
 
-            if factory_choice != "Summary All Plant":
-                f_conf = FACTORY_CONFIG[factory_choice]
-
-                sb.write(f"🧪 Fetching chemical data for {factory_choice}...")
-                df_conc = (get_data_pi(f_conf["cip_tag"], auth, s_dt, e_dt)
-                           if f_conf["cip_tag"] else pd.DataFrame(columns=['Time', 'Val']))
-
-                sb.write(f"🌡️ Fetching {len(f_conf['tags'])} tanks in parallel...")
-                all_dfs, errs = fetch_all_tags_parallel(f_conf["tags"], auth, s_dt, e_dt)
-                if errs: st.session_state.fetch_errors = errs
-
-                for name, df_temp in all_dfs.items():
-                    sb.write(f"⚙️ Analysing tank: {name}...")
-                    if not df_temp.empty:
-                        hist = process_logic(df_temp, df_conc, target_t, min_m)
-                        if hist:
-                            passed = sum(1 for h in hist if h["Status"] == "PASS")
-                            st.session_state.results[name] = {
-                                "summary": hist[-1],
-                                "p_rate": round(passed / len(hist) * 100, 1),
-                                "total": len(hist), "pass": passed, "list": hist,
-                                "raw_temp": df_temp, "raw_conc": df_conc,
-                                "factory": factory_choice
-                            }
-
-                found = len(st.session_state.results)
-                sb.update(label=f"✅ Completed {factory_choice} — — data found {found}/{len(f_conf['tags'])} tank(s)",
-                          state="complete", expanded=False)
-
+            pre = load_precomputed(s_dt, e_dt) if pre_mode else None
+            if pre and set(factories) <= set(pre["factories"]):
+                sb.write(f"📦 Precomputed cycle history from {datetime.fromtimestamp(pre['created']):%Y-%m-%d %H:%M}")
+                errs = {k: e for k, e in pre["errors"].items() if k.split("/")[0] in factories}
+                for (f, tank), idx in pre["index"].items():
+                    if f not in factories: continue
+                    c = factories[f]
+                    raw = (None, None) if summary else (load_days(c["tags"][tank], s_dt, e_dt),
+                                                        load_days(c["cip_tag"], s_dt, e_dt) if c["cip_tag"]
+                                                        else pd.DataFrame(columns=['Time', 'Val']))
+                    _keep(f, tank, *raw, idx)
+            elif batch_mode:
+                sb.write(f"⚡ Fetching {n_tanks} tanks + chemical data in PI batch mode...")
+                batch_dfs, b_errs = fetch_batch({(f, k): tag for f, c in factories.items()
+                                                 for k, tag in {**c["tags"], "_conc": c["cip_tag"]}.items()},
+                                                client, s_dt, e_dt)
+                pages, points = pi_traffic(*batch_dfs.values())
+                errs = {label(f, t) if t != "_conc" else f"{f}/%CIP": e for (f, t), e in b_errs.items()}
+                concs = {f: batch_dfs.pop((f, "_conc")) for f in factories}
+                jobs  = {(f, tank): (df_temp, concs[f]) for (f, tank), df_temp in batch_dfs.items()
+                         if not df_temp.empty}
+                sb.write(f"⚙️ Analysing {len(jobs)} tank(s)...")
+                for (f, tank), idx in build_cycle_indexes(jobs, analysis_workers).items():
+                    _keep(f, tank, *jobs[(f, tank)], idx)
             else:
-                st.session_state.results = {"_is_summary": True}
-                for f_name, f_conf in FACTORY_CONFIG.items():
-                    sb.write(f"🏭 Fetching factory: {f_name}...")
-                    st.session_state.results[f_name] = []
-                    df_conc = (get_data_pi(f_conf["cip_tag"], auth, s_dt, e_dt)
-                               if f_conf["cip_tag"] else pd.DataFrame(columns=['Time', 'Val']))
-                    all_dfs, _ = fetch_all_tags_parallel(f_conf["tags"], auth, s_dt, e_dt)
-                    for name, df_temp in all_dfs.items():
-                        if not df_temp.empty:
-                            for h in process_logic(df_temp, df_conc, target_t, min_m):
-                                st.session_state.results[f_name].append({**h, "Tank": name})
+                sb.write(f"🌡️ Fetching {n_tanks} tanks + chemical data on one shared pool...")
+                for done, total, kind, f_name, tank, payload in analyse_plant(
+                        factories, client, s_dt, e_dt, analysis_workers=analysis_workers):
+                    step = f"`{done}/{total}`"
+                    if kind == "error":
+                        errs[label(f_name, tank) if tank else f"{f_name}/%CIP"] = payload
+                        sb.write(f"{step} ❌ {label(f_name, tank or '%CIP')}: {payload}")
+                    elif kind == "index":
+                        _keep(f_name, tank, *payload)
+                        sb.write(f"{step} ⚙️ Analysed {label(f_name, tank)}: {len(payload[2])} cycle(s)")
+                    else:
+                        p, n = pi_traffic(payload); pages += p; points += n
+                        what = f"🧪 Chemical data {f_name}" if kind == "conc" else f"🌡️ Fetched {label(f_name, tank)}"
+                        sb.write(f"{step} {what} ({len(payload):,} pts)")
+
+            if errs: st.session_state.fetch_errors = errs
+            st.session_state.cycles = CycleTable(
+                cycle_index, list(FACTORY_CONFIG), list(dict.fromkeys(t for c in FACTORY_CONFIG.values() for t in c["tags"])))
+            sb.write(f"📦 Downloaded {points:,} point(s) in {pages} page(s) from PI")
+            st.session_state.perf = (time.time() - perf_mark[0], METRICS.snapshot(perf_mark))
+            if summary:
                 sb.update(label="✅ CompletedAll factory data loaded",
                           state="complete", expanded=False)
+            else:
+                found = len(st.session_state.results)
+                sb.update(label=f"✅ Completed {factory_choice} — — data found {found}/{n_tanks} tank(s)",
+                          state="complete", expanded=False)
+
+# Target Temp / Target Duration only re-score the cached cycle indexes
+if st.session_state.cycles is not None and st.session_state.scored_for != (target_t, min_m):
+    rescore_results(target_t, min_m)
 
 if st.session_state.fetch_errors:
     with st.expander(f"⚠️ Failed to fetch data for {len(st.session_state.fetch_errors)} tank(s)tank(s) failed to load"):
@@ -360,62 +230,231 @@ if st.session_state.fetch_errors:
             st.markdown(f'<div class="error-box">❌ <b>{tank}</b>: {err}</div>',
                         unsafe_allow_html=True)
 
+if st.session_state.perf and st.session_state.perf[1]:
+    elapsed, rows = st.session_state.perf
+    with st.expander(f"⏱️ Performance — last run {elapsed:.1f}s", expanded=False):
+        perf = pd.DataFrame(rows)
+        stages = perf.groupby("stage", sort=False).agg(
+            {c: "sum" for c in perf.columns if c not in ("stage", "tag") and not c.endswith("_ms")})
+        stages["p95_ms"] = perf.groupby("stage", sort=False)["p95_ms"].max() if "p95_ms" in perf else None
+        st.caption("Stage totals — seconds are summed over parallel workers, so they can exceed the wall time")
+        st.dataframe(stages.round(3), use_container_width=True)
+        st.caption("Per tag / endpoint")
+        st.dataframe(perf.round(3), use_container_width=True, hide_index=True)
+
+
+# ============================================================
+# LIVE — fragment polled every LIVE_POLL_SEC, only new points are read and analysed
+# ============================================================
+@st.fragment(run_every=LIVE_POLL_SEC)
+def live_panel(f_name, user, pw, use_async, target_t, min_m):
+    f_conf = FACTORY_CONFIG[f_name]
+    live   = st.session_state.live
+    if live is None or live["factory"] != f_name:
+        feed = LiveFeed(get_pi_client(user, pw, use_async), {**f_conf["tags"], "_conc": f_conf["cip_tag"]})
+        live = st.session_state.live = {"factory": f_name, "feed": feed,
+                                        "trackers": {k: CycleTracker(bool(f_conf["cip_tag"])) for k in f_conf["tags"]}}
+    frames, errs = live["feed"].poll()
+    conc = frames.pop("_conc", None)
+    for tank, tracker in live["trackers"].items():
+        tracker.feed(frames.get(tank, pd.DataFrame(columns=['Time', 'Val'])), conc)
+
+    st.subheader(f"📡 Live: {f_name}")
+    st.caption(f"Updated {live['feed'].polled:%H:%M:%S} · {sum(len(df) for df in frames.values()):,} new point(s)"
+               f" · refresh every {LIVE_POLL_SEC}s")
+    for k, err in errs.items():
+        st.markdown(f'<div class="error-box">❌ <b>{k}</b>: {err}</div>', unsafe_allow_html=True)
+
+    cols, rows = st.columns(4), []
+    for i, (tank, tracker) in enumerate(live["trackers"].items()):
+        cur  = tracker.current() if tracker.running else tracker.current(MIN_DURATION)
+        hist = score_cycles(tracker.index + ([cur] if cur else []), target_t, min_m)
+        rows += [dict(h, Tank=tank) for h in hist]
+        now_t = f"{tracker.last_v:.1f}°C" if tracker.last_v is not None else "–"
+        if tracker.running and cur:
+            h, state, css = hist[-1], "🔄 CIP running", "status-pass" if hist[-1]["Status"] == "PASS" else ""
+        elif hist:
+            h = hist[-1]; state = "✅ Last cycle" if cur is None else "⏳ Cycle ended"
+            css = "status-pass" if h["Status"] == "PASS" else "status-fail"
+        else:
+            h, state, css = None, "💤 Idle", ""
+        detail = (f"🕒 {h['StartTime']} · {h['TotalDuration']} min<br>"
+                  f"🌡️ >{target_t}°C: {h['TimeAboveTarget']} / {min_m:g} min · <b>{h['Status']}</b>") if h else ""
+        with cols[i % 4]:
+            st.markdown(
+                f"""<div class="tank-card {css}">
+                    <h4 style="margin:0;font-size:1.05em;color:#2c3e50;">{tank}</h4>
+                    <div class="latest-time">{state} · now {now_t}</div>
+                    <div class="metric-box">{detail or 'No cycle in the live window'}</div></div>""",
+                unsafe_allow_html=True)
+
+    if rows:
+        df_live = pd.DataFrame(rows)
+        fig_lv  = go.Figure()
+        for status, color in [("PASS", "#28a745"), ("FAIL", "#dc3545")]:
+            ds = df_live[df_live["Status"] == status]
+            if ds.empty: continue
+            fig_lv.add_trace(go.Bar(x=(ds["End"] - ds["Start"]).dt.total_seconds() * 1000, base=ds["Start"],
+                                    y=ds["Tank"], orientation="h", name=status, marker_color=color,
+                                    customdata=ds[["TotalDuration", "TimeAboveTarget", "StartTime"]],
+                                    hovertemplate="<b>%{y}</b><br>🕒 %{customdata[2]}<br>⏱️ %{customdata[0]}m"
+                                                  "<br>🌡️ > Target: %{customdata[1]}m<extra></extra>"))
+        fig_lv.update_layout(height=120 + 25 * df_live["Tank"].nunique(), barmode="overlay",
+                             xaxis=dict(type="date"), margin=dict(l=10, r=10, t=10, b=10))
+        st.plotly_chart(fig_lv, use_container_width=True, key="live_timeline", config={'displayModeBar': False})
+
+
+if live_mode and factory_choice != "Summary All Plant":
+    if user and pw:
+        st.divider()
+        live_panel(factory_choice, user, pw, async_mode, target_t, min_m)
+    else:
+        st.info("📡 Live mode needs Username and Password")
+else:
+    st.session_state.live = None
+
+
+# ============================================================
+# RENDER — figure specs cached per results version
+# ============================================================
+FACTORY_COLORS = {"PK1":"#1a73e8","PK2":"#e8711a",
+                  "KN":"#28a745","DC":"#9b27af","MCE":"#e8291a"}
+
+
+def cached_figure(name, build):
+    """Figure of the current run + targets: built once, reused by every rerun until either changes"""
+    figs, ver = st.session_state.figs, (st.session_state.run_id, st.session_state.scored_for)
+    if figs.get("_ver") != ver:
+        figs.clear(); figs["_ver"] = ver
+    if name not in figs: figs[name] = build()
+    return figs[name]
+
+
+def gauge_figure(p_rate):
+    fig_g = go.Figure(go.Indicator(
+        mode="gauge", value=p_rate,
+        gauge={'axis': {'range': [0,100], 'visible': False},
+               'bar': {'color': "#28a745" if p_rate >= 80 else "#dc3545"},
+               'bgcolor': "#ececec", 'borderwidth': 0}))
+    fig_g.add_annotation(x=0.5, y=0.01, text=f"<b>{p_rate}%</b>",
+                         showarrow=False, font=dict(size=18))
+    fig_g.update_layout(height=100, margin=dict(l=10,r=10,t=10,b=10),
+                        paper_bgcolor='rgba(0,0,0,0)')
+    return fig_g
+
+
+def timeline_figure(df, row, order):
+    """Every cycle of `df` as ONE WebGL marker trace: a row per `row` value (Tank or Factory),
+    green/red by PASS/FAIL; x/y/colour/customdata are numeric, so plotly ships them as binary arrays"""
+    df  = df.sort_values("Start", kind="stable")
+    pos = pd.Categorical(df[row], categories=order).codes
+    fig_tl = go.Figure(go.Scattergl(
+        x=df["Start"].to_numpy() / 1e6, y=pos, mode="markers",   # epoch ms on a date axis
+        marker=dict(symbol="square", size=9, color=df["Pass"].to_numpy().astype("int8"),
+                    colorscale=[[0, "#dc3545"], [1, "#28a745"]], cmin=0, cmax=1),
+        text=df["Tank"].astype(str),
+        customdata=np.column_stack([df["TotalDuration"], df["TimeAboveTarget"], df["AvgConc"]]).astype("float32"),
+        hovertemplate="<b>Tank: %{text}</b><br>🕒 Start: %{x|%Y-%m-%d %H:%M}<br>⏱️ Duration: %{customdata[0]}m"
+                      "<br>🌡️ Time > Target: %{customdata[1]}m<br>🧪 %CIP: %{customdata[2]:.2f}%<extra></extra>"))
+    fig_tl.update_layout(height=160 + 28 * len(order), dragmode='pan', showlegend=False,
+        margin=dict(l=10, r=10, t=10, b=10),
+        xaxis=dict(type='date', rangeslider=dict(visible=True)),
+        yaxis=dict(tickvals=list(range(len(order))), ticktext=order,
+                   range=[len(order) - 0.5, -0.5], fixedrange=True))
+    return fig_tl
+
+
+def monthly_figure(monthly):
+    """Grouped monthly %Pass bars from the run's month rollup"""
+    months      = pd.to_datetime(monthly["Month"])
+    month_order = months.drop_duplicates().sort_values().dt.strftime("%b %Y").tolist()
+    monthly     = monthly.assign(Month=months.dt.strftime("%b %Y"))   # "Jan 2026" — one row per factory/month
+    fig_m = go.Figure()
+    for fn in FACTORY_CONFIG:
+        dm = monthly[monthly["Factory"]==fn]
+        if dm.empty: continue
+        fig_m.add_trace(go.Bar(
+            x=dm["Month"], y=dm["%Pass"], name=fn,
+            marker_color=FACTORY_COLORS.get(fn,"#888"),
+            text=dm["%Pass"].astype(str)+"%",
+            textposition="outside",
+            textfont=dict(size=10),
+            hovertemplate=f"<b>{fn}</b><br>Month: %{{x}}<br>%Pass: %{{y}}%<extra></extra>"
+        ))
+    fig_m.add_hline(y=80, line_dash="dash", line_color="#dc3545", line_width=1.5,
+                    annotation_text="Target 80%", annotation_position="bottom right",
+                    annotation_font_color="#dc3545")
+    fig_m.update_layout(
+        barmode="group",
+        dragmode='pan',
+        height=450,
+        yaxis=dict(title="%Pass Rate", range=[0,120], ticksuffix="%"),
+        xaxis=dict(title="Month", tickangle=-30, categoryorder="array", categoryarray=month_order),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        plot_bgcolor="white", paper_bgcolor="white",
+        margin=dict(t=60, b=60)
+    )
+    fig_m.update_xaxes(showgrid=False)
+    fig_m.update_yaxes(showgrid=True, gridcolor="#f0f0f0")
+    return fig_m
+
+
+def _toggle_history(name):
+    st.session_state.view_history = None if st.session_state.view_history == name else name
+
 
 # ============================================================
-# DASHBOARD (unchanged 100%)
+# DASHBOARD
 # ============================================================
-if st.session_state.results:
+if st.session_state.results and st.session_state.scored is not None:
+    scored, rollups = st.session_state.scored, st.session_state.rollups
     if "_is_summary" not in st.session_state.results:
+        run_factory = st.session_state.run_factory
         st.divider()
-        st.subheader(f"🏭 Plant: {factory_choice}")
+        st.subheader(f"🏭 Plant: {run_factory}")
         cols = st.columns(4)
         # Sort tanks in order defined by FACTORY_CONFIG
-        tag_order = FACTORY_CONFIG.get(factory_choice, {}).get("tags", {}).keys()
+        tag_order = FACTORY_CONFIG.get(run_factory, {}).get("tags", {}).keys()
         ordered_tanks = [n for n in tag_order if n in st.session_state.results]
         if not ordered_tanks:  # fallback fallback for Summary All Plant
             ordered_tanks = list(st.session_state.results.keys())
+        f_rows = scored[scored["Factory"] == run_factory]
+        latest = f_rows.groupby("Tank", observed=True).tail(1).set_index("Tank")   # rows are time-ordered per tank
+        t_rate = rollups["tank"].loc[run_factory] if run_factory in rollups["tank"].index else pd.DataFrame()
+        ordered_tanks = [n for n in ordered_tanks if n in latest.index and n in t_rate.index]
         for i, name in enumerate(ordered_tanks):
             data = st.session_state.results[name]
-            res = data["summary"]
+            res, rate = latest.loc[name], t_rate.loc[name]
             with cols[i % 4]:
-                fig_g = go.Figure(go.Indicator(
-                    mode="gauge", value=data['p_rate'],
-                    gauge={'axis': {'range': [0,100], 'visible': False},
-                           'bar': {'color': "#28a745" if data['p_rate'] >= 80 else "#dc3545"},
-                           'bgcolor': "#ececec", 'borderwidth': 0}))
-                fig_g.add_annotation(x=0.5, y=0.01, text=f"<b>{data['p_rate']}%</b>",
-                                     showarrow=False, font=dict(size=18))
-                fig_g.update_layout(height=100, margin=dict(l=10,r=10,t=10,b=10),
-                                    paper_bgcolor='rgba(0,0,0,0)')
                 st.markdown(
-                    f"""<div class="tank-card {'status-pass' if res['Status']=='PASS' else 'status-fail'}">
+                    f"""<div class="tank-card {'status-pass' if res['Pass'] else 'status-fail'}">
                         <h4 style="margin:0;font-size:1.05em;color:#2c3e50;">{name}</h4>
-                        <div class="latest-time">🕒 Latest: {res['StartTime']}</div>""",
+                        <div class="latest-time">🕒 Latest: {pd.Timestamp(res['Start']):%Y-%m-%d %H:%M}</div>""",
                     unsafe_allow_html=True)
-                st.plotly_chart(fig_g, use_container_width=True,
+                st.plotly_chart(cached_figure(f"gauge_{name}", lambda: gauge_figure(rate['%Pass'])),
+                                use_container_width=True,
                                 config={'displayModeBar': False, 'scrollZoom': True}, key=f"gauge_{name}")
-                cip_d = f"{res['AvgConc']}%" if FACTORY_CONFIG[data["factory"]]["cip_tag"] else "N/A"
+                cip_d = f"{res['AvgConc']:.2f}%" if FACTORY_CONFIG[data["factory"]]["cip_tag"] else "N/A"
                 st.markdown(
-                    f"""<div style="font-size:0.68em;color:#7f8c8d;margin-top:-12px;margin-bottom:5px;">PASS {data['pass']}/{data['total']}</div>
+                    f"""<div style="font-size:0.68em;color:#7f8c8d;margin-top:-12px;margin-bottom:5px;">PASS {int(rate['Pass'])}/{int(rate['Total'])}</div>
                         <div class="metric-box">
                             ⏱️ <b>Time:</b> {res['TotalDuration']} min (<b>>{target_t}°C:</b> {res['TimeAboveTarget']} min)<br>
                             🌡️ <b>Temp avg:</b> {res['AvgTemp']}°C (<b>>{target_t}°C:</b> {res['AvgTempTarget']}°C)<br>
                             🔥 <b>Temp Max:</b> {res['MaxTemp']}°C<br>
                             🧪 <b>%CIP:</b> {cip_d}
                         </div></div>""", unsafe_allow_html=True)
-                if st.button(f"🔍 HISTORY: {name}", key=f"btn_{name}", use_container_width=True):
-                    st.session_state.view_history = name
+                opened = st.session_state.view_history == name
+                st.button(f"{'🔼 HIDE' if opened else '🔍 HISTORY'}: {name}", key=f"btn_{name}",
+                          use_container_width=True, on_click=_toggle_history, args=(name,))
 
         # --- Summary badge Overall stats for all tanks in factory ---
-        all_results = [d for n, d in st.session_state.results.items() if n != "_is_summary"]
-        if all_results:
-            tc_all = sum(d["total"] for d in all_results)
-            pc_all = sum(d["pass"]  for d in all_results)
+        if run_factory in rollups["factory"].index:
+            tc_all, pc_all = (int(x) for x in rollups["factory"].loc[run_factory, ["Total", "Pass"]])
             fc_all = tc_all - pc_all
             rt_all = round(pc_all / tc_all * 100, 1) if tc_all else 0
             st.markdown(
                 f"""<div style="background:#fff;padding:12px;border-radius:10px;border:1px solid #eee;margin-bottom:10px;">
-                    <span style="font-size:0.9em;font-weight:bold;color:#555;">📊 {factory_choice} Overall:</span>
+                    <span style="font-size:0.9em;font-weight:bold;color:#555;">📊 {run_factory} Overall:</span>
                     <span class="summary-badge" style="background:#1a73e8;">Total: {tc_all}</span>
                     <span class="summary-badge" style="background:#28a745;">Pass: {pc_all}</span>
                     <span class="summary-badge" style="background:#dc3545;">Fail: {fc_all}</span>
@@ -424,111 +463,33 @@ if st.session_state.results:
 
         st.divider()
         st.subheader("📅 CIP Timeline")
-        all_data = [dict(c, Tank=n) for n, d in st.session_state.results.items()
-                    if n != "_is_summary" for c in d["list"]]
-        if all_data:
-            df_all = pd.DataFrame(all_data).sort_values("Start")
-            BAR_WIDTH_MS = 90 * 60 * 1000  # 90 นาที คงที่ทุกแท่ง
-            fig_tl = go.Figure()
-            for status, color in [("PASS","#28a745"),("FAIL","#dc3545")]:
-                ds = df_all[df_all["Status"]==status]
-                if not ds.empty:
-                    fig_tl.add_trace(go.Bar(x=ds["Start"], y=[1]*len(ds),
-                        width=BAR_WIDTH_MS,
-                        name=status, marker_color=color,
-                        customdata=ds[["Tank","TotalDuration","TimeAboveTarget","AvgConc","StartTime","End"]],
-                        hovertemplate="<b>Tank: %{customdata[0]}</b><br>🕒 Start: %{customdata[4]}<br>⏱️ Duration: %{customdata[1]}m<br>🌡️ Time > Target: %{customdata[2]}m<br>🧪 %CIP: %{customdata[3]}%<extra></extra>"))
-            fig_tl.update_layout(height=300, dragmode='pan',
-                barmode='overlay',
-                bargap=0,
-                xaxis=dict(type='date', rangeslider=dict(visible=True)),
-                yaxis=dict(visible=False, range=[0, 1.5]))
-            st.plotly_chart(fig_tl, use_container_width=True, config={'scrollZoom': True})
+        if len(f_rows):
+            fig_tl = cached_figure("timeline", lambda: timeline_figure(f_rows, "Tank", ordered_tanks))
+            st.plotly_chart(fig_tl, use_container_width=True, key="timeline", config={'scrollZoom': True})
 
     else:
         st.divider()
         st.subheader("🌍 Summary All Plant")
 
         # --- Monthly %Pass chart — all factories in one graph ---
-        all_factory_data = []
-        for f_name in FACTORY_CONFIG:
-            for h in st.session_state.results.get(f_name, []):
-                all_factory_data.append({**h, "Factory": f_name})
-
-        if all_factory_data:
-            df_all_f = pd.DataFrame(all_factory_data)
-            df_all_f["_period"] = pd.to_datetime(df_all_f["Start"]).dt.to_period("M")
-            df_all_f["Month"]   = df_all_f["_period"].dt.strftime("%b %Y")   # "Jan 2026"
-            # sort key เพื่อให้เรียงตามเวลาจริง
-            month_order = (df_all_f[["_period","Month"]].drop_duplicates()
-                           .sort_values("_period")["Month"].tolist())
-            monthly = (df_all_f.groupby(["Factory","Month"])
-                       .apply(lambda g: round(len(g[g["Status"]=="PASS"])/len(g)*100, 1))
-                       .reset_index(name="%Pass"))
-            # เรียงตาม month_order
-            monthly["Month"] = pd.Categorical(monthly["Month"], categories=month_order, ordered=True)
-            monthly = monthly.sort_values("Month")
-
-            FACTORY_COLORS = {"PK1":"#1a73e8","PK2":"#e8711a",
-                               "KN":"#28a745","DC":"#9b27af","MCE":"#e8291a"}
-
+        if len(rollups["month"]):
             st.subheader("📈 Monthly %Pass Rate — All Factories")
-            fig_m = go.Figure()
-            for fn in FACTORY_CONFIG:
-                dm = monthly[monthly["Factory"]==fn]
-                if dm.empty: continue
-                fig_m.add_trace(go.Bar(
-                    x=dm["Month"], y=dm["%Pass"], name=fn,
-                    marker_color=FACTORY_COLORS.get(fn,"#888"),
-                    text=dm["%Pass"].astype(str)+"%",
-                    textposition="outside",
-                    textfont=dict(size=10),
-                    hovertemplate=f"<b>{fn}</b><br>Month: %{{x}}<br>%Pass: %{{y}}%<extra></extra>"
-                ))
-            fig_m.add_hline(y=80, line_dash="dash", line_color="#dc3545", line_width=1.5,
-                            annotation_text="Target 80%", annotation_position="bottom right",
-                            annotation_font_color="#dc3545")
-            fig_m.update_layout(
-                barmode="group",
-                dragmode='pan',
-                height=450,
-                yaxis=dict(title="%Pass Rate", range=[0,120], ticksuffix="%"),
-                xaxis=dict(title="Month", tickangle=-30),
-                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-                plot_bgcolor="white", paper_bgcolor="white",
-                margin=dict(t=60, b=60)
-            )
-            fig_m.update_xaxes(showgrid=False)
-            fig_m.update_yaxes(showgrid=True, gridcolor="#f0f0f0")
+            fig_m = cached_figure("monthly", lambda: monthly_figure(rollups["month"].reset_index()))
             st.plotly_chart(fig_m, use_container_width=True, key="monthly_passrate", config={'scrollZoom': True})
 
         st.divider()
-        for f_name in FACTORY_CONFIG:
-            f_data = st.session_state.results.get(f_name, [])
-            if not f_data: continue
-            st.markdown(f"### 🏭 Factory: {f_name}")
-            df_f = pd.DataFrame(f_data).sort_values("Start")
-            tc, pc = len(df_f), len(df_f[df_f["Status"]=="PASS"])
-            rate = round(pc/tc*100,1) if tc else 0
-            BAR_WIDTH_MS = 90 * 60 * 1000  # 90 นาที คงที่ทุกแท่ง
-            fig_tl = go.Figure()
-            for status, color in [("PASS","#28a745"),("FAIL","#dc3545")]:
-                ds = df_f[df_f["Status"]==status]
-                if not ds.empty:
-                    fig_tl.add_trace(go.Bar(x=ds["Start"], y=[1]*len(ds),
-                        width=BAR_WIDTH_MS,
-                        name=status, marker_color=color,
-                        customdata=ds[["Tank","TotalDuration","TimeAboveTarget","AvgConc","StartTime","End"]],
-                        hovertemplate="<b>Tank: %{customdata[0]}</b><br>🕒 Start: %{customdata[4]}<br>⏱️ Duration: %{customdata[1]}m<br>🌡️ Time > Target: %{customdata[2]}m<br>🧪 %CIP: %{customdata[3]}%<extra></extra>"))
-            fig_tl.update_layout(height=300, dragmode='pan',
-                barmode='overlay',
-                bargap=0,
-                xaxis=dict(type='date', rangeslider=dict(visible=True)),
-                yaxis=dict(visible=False, range=[0, 1.5]))
-            st.plotly_chart(fig_tl, use_container_width=True, key=f"tl_{f_name}", config={'scrollZoom': True})
+        by_factory = rollups["factory"]
+        f_order    = [f for f in FACTORY_CONFIG if f in by_factory.index]
+        if f_order:
+            st.subheader("📅 CIP Timeline — All Factories")
+            fig_tl = cached_figure("timeline", lambda: timeline_figure(scored, "Factory", f_order))
+            st.plotly_chart(fig_tl, use_container_width=True, key="timeline", config={'scrollZoom': True})
+        for f_name in f_order:
+            tc, pc, rate = by_factory.loc[f_name, ["Total", "Pass", "%Pass"]]
+            tc, pc = int(tc), int(pc)
             st.markdown(
-                f"""<div style="background:#fff;padding:12px;border-radius:10px;border:1px solid #eee;margin-top:-10px;margin-bottom:25px;">
-                    <span style="font-size:0.9em;font-weight:bold;color:#555;">📊 {f_name} Stats:</span>
+                f"""<div style="background:#fff;padding:12px;border-radius:10px;border:1px solid #eee;margin-bottom:10px;">
+                    <span style="font-size:0.9em;font-weight:bold;color:#555;">🏭 {f_name} Stats:</span>
                     <span class="summary-badge" style="background:#1a73e8;">Total: {tc}</span>
                     <span class="summary-badge" style="background:#28a745;">Pass: {pc}</span>
                     <span class="summary-badge" style="background:#dc3545;">Fail: {tc-pc}</span>
@@ -537,33 +498,49 @@ if st.session_state.results:
 
 
 # ============================================================
-# HISTORY EXPLORER (unchanged 100%)
+# HISTORY EXPLORER — one tank, rendered only while its card is open;
+# picking another cycle reruns this fragment only
 # ============================================================
-if st.session_state.view_history and st.session_state.view_history in st.session_state.results:
-    sel = st.session_state.view_history
-    db  = st.session_state.results[sel]
+@st.fragment
+def history_panel(sel):
+    db = st.session_state.results[sel]
+    scored = st.session_state.scored
     st.divider()
     st.subheader(f"📊 Detailed History: {sel} ({db['factory']})")
-    hist_df  = pd.DataFrame(db["list"]).sort_values("StartTime", ascending=False)
-    label_fn = lambda x: f"No. {x['No']} | {x['StartTime']} | {x['Status']}"
-    opt      = st.selectbox("Select Item No.:", hist_df.apply(label_fn, axis=1).tolist())
-    r_data   = hist_df[hist_df.apply(label_fn, axis=1) == opt].iloc[0]
+    hist_df  = scored[(scored["Factory"] == db["factory"]) & (scored["Tank"] == sel)].iloc[::-1]   # newest first
+    hist_df  = hist_df.assign(StartTime=pd.to_datetime(hist_df["Start"]).dt.strftime("%Y-%m-%d %H:%M"),
+                              Status=np.where(hist_df["Pass"], "PASS", "FAIL"))
+    labels   = ("No. " + hist_df["No"].astype(str) + " | " + hist_df["StartTime"] + " | " + hist_df["Status"]).tolist()
+    opt      = st.selectbox("Select Item No.:", labels)
+    r_data   = hist_df.iloc[labels.index(opt)]
     fig_h    = make_subplots(specs=[[{"secondary_y": True}]])
-    mask     = ((db["raw_temp"]["Time"] >= r_data["Start"] - timedelta(minutes=10)) &
-                (db["raw_temp"]["Time"] <= r_data["End"]   + timedelta(minutes=10)))
-    fig_h.add_trace(go.Scatter(x=db["raw_temp"].loc[mask,'Time'],
-                               y=db["raw_temp"].loc[mask,'Val'],
+    w0, w1   = pd.Timestamp(r_data["Start"]) - timedelta(minutes=10), pd.Timestamp(r_data["End"]) + timedelta(minutes=10)
+
+    def _window(tag, raw):
+        # ±10 min window from the day files → session frame → PI /plot, cut to PLOT_POINTS
+        win = load_window(tag, w0, w1) if tag else raw.iloc[:0]
+        if win.empty: win = time_slice(raw, w0, w1)
+        if win.empty and tag and user and pw: win = fetch_plot(get_pi_client(user, pw), tag, w0, w1)
+        return downsample(win)
+
+    win_t = _window(FACTORY_CONFIG[db["factory"]]["tags"].get(sel), db["raw_temp"])
+    fig_h.add_trace(go.Scatter(x=win_t['Time'], y=win_t['Val'],
                                name="Temp (°C)", line=dict(color="#e74c3c", width=3)))
     if not db["raw_conc"].empty:
-        cm = ((db["raw_conc"]["Time"] >= r_data["Start"] - timedelta(minutes=10)) &
-              (db["raw_conc"]["Time"] <= r_data["End"]   + timedelta(minutes=10)))
-        fig_h.add_trace(go.Scatter(x=db["raw_conc"].loc[cm,'Time'],
-                                   y=db["raw_conc"].loc[cm,'Val'],
+        win_c = _window(FACTORY_CONFIG[db["factory"]]["cip_tag"], db["raw_conc"])
+        fig_h.add_trace(go.Scatter(x=win_c['Time'], y=win_c['Val'],
                                    name="%CIP Conc",
                                    line=dict(color="#3498db", width=2, dash='dot')),
                         secondary_y=True)
     fig_h.update_layout(xaxis_title="Time", yaxis_title="Temp (°C)", dragmode="pan")
     st.plotly_chart(fig_h, use_container_width=True, config={'scrollZoom': True})
-    st.dataframe(hist_df.drop(columns=["Start","End"]), use_container_width=True, hide_index=True)
+    st.dataframe(hist_df[["No", "StartTime", "TotalDuration", "TimeAboveTarget", "MaxTemp", "AvgTemp",
+                          "AvgTempTarget", "AvgConc", "Status"]].astype({"AvgConc": "float64"}).round({"AvgConc": 2}),
+                 use_container_width=True, hide_index=True)
     if st.button("✖️ Close History"):
-        st.session_state.view_history = None; st.rerun()
\ No newline at end of file
+        st.session_state.view_history = None; st.rerun()
+
+
+if (st.session_state.view_history and st.session_state.view_history in st.session_state.results
+        and st.session_state.scored is not None):
+    history_panel(st.session_state.view_history)
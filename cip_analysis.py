@@ -0,0 +1,333 @@
+"""
+CIP cycle analysis — detection, per-cycle index, scoring
+========================================================
+- Pure NumPy/pandas (no Streamlit) so process-pool workers can import it
+- build_cycle_index(): threshold-independent work, once per fetched dataset
+- score_cycles(): any Target Temp / Target Duration by binary search
+- CycleTable: every cycle index of a run as typed columns, scored and rolled up vectorised
+- CycleTracker: the same index built incrementally from live polls
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+TRIGGER_TEMP  = 40.0   # อุณหภูมิเริ่มนับว่าอาจเป็น CIP (°C)
+MIN_DURATION  = 15.0   # ✅ ต้องสูงกว่า TRIGGER_TEMP ติดต่อกันอย่างน้อย 15 นาที
+                       #    จึงนับเป็น CIP cycle (กรองอุณหภูมิสูงชั่วคราว)
+GAP_MIN       = 45     # ช่องว่างระหว่าง cycle ที่ถือว่ายังเป็น cycle เดียวกัน (นาที)
+
+
+def _detect_cycles(t, v):
+    """Merged CIP periods as (start, end) datetime64 arrays.
+
+    Same periods as the old row-by-row state machine: a period opens on the first
+    Val > TRIGGER_TEMP, closes on the next Val <= TRIGGER_TEMP (NaN never changes
+    state, a period still open at the end is dropped) and periods less than GAP_MIN
+    apart are joined.
+    """
+    ok = ~np.isnan(v); t = t[ok]
+    step = np.diff((v[ok] > TRIGGER_TEMP).astype(np.int8), prepend=np.int8(0))
+    ends = np.flatnonzero(step == -1)
+    starts = np.flatnonzero(step == 1)[:len(ends)]
+    if not len(starts): return t[:0], t[:0]
+    s, e = t[starts], t[ends]
+    new = np.r_[True, (s[1:] - e[:-1]) > np.timedelta64(GAP_MIN * 60, 's')]
+    return s[new], e[np.r_[new[1:], True]]
+
+
+def build_cycle_index(temp_df, conc_df):
+    """Threshold-independent part of process_logic — run once per fetched dataset.
+
+    One record per CIP cycle with its fixed metrics plus the 10 s interpolated
+    temperatures sorted ascending ("grid") and their prefix sums ("csum"), so that
+    score_cycles() can answer any Target Temp / Target Duration by binary search.
+    """
+    index = []
+
+    if temp_df.empty: return []
+
+    combined_df = (pd.merge_asof(temp_df.sort_values('Time'),
+                                 conc_df.sort_values('Time').rename(columns={'Val': 'Conc'}),
+                                 on='Time', direction='backward')
+                   if not conc_df.empty else temp_df.assign(Conc=0))
+    if not combined_df['Time'].is_monotonic_increasing:
+        combined_df = combined_df.sort_values('Time', kind='stable')
+
+    t = combined_df['Time'].to_numpy('datetime64[ns]')
+    starts, ends = _detect_cycles(t, combined_df['Val'].to_numpy('float64'))
+    lo, hi = np.searchsorted(t, starts, 'left'), np.searchsorted(t, ends, 'right')
+
+    for no, (s_t, e_t, i0, i1) in enumerate(zip(starts, ends, lo, hi), 1):
+        rec = _cycle_record(no, s_t, e_t, combined_df.iloc[i0:i1])
+        if rec: index.append(rec)
+    return index
+
+
+def _cycle_record(no, start, end, cyc, min_duration=MIN_DURATION):
+    """Index record of one merged period from its Time/Val/Conc rows (None when filtered out)"""
+    p = {'Start': pd.Timestamp(start), 'End': pd.Timestamp(end)}
+    # ✅ กรองทิ้ง: อุณหภูมิสูงชั่วคราว < 15 นาที ไม่ถือเป็น CIP
+    if (p['End'] - p['Start']).total_seconds() / 60 < min_duration: return None
+    if len(cyc) < 2: return None
+
+    cyc  = cyc.set_index('Time').sort_index()
+    cyc  = cyc[~cyc.index.duplicated(keep='first')]
+    idx  = pd.date_range(start=p['Start'], end=p['End'], freq='10s')
+    rs   = cyc.reindex(cyc.index.union(idx)).interpolate('linear').reindex(idx)
+    grid = np.sort(rs['Val'].dropna().to_numpy('float64'))
+    return {
+        "No": no, "Start": p['Start'], "End": p['End'],
+        "StartTime": p['Start'].strftime("%Y-%m-%d %H:%M"),
+        "TotalDuration": int(round((p['End'] - p['Start']).total_seconds() / 60)),
+        "MaxTemp": int(round(cyc['Val'].max())),
+        "AvgTemp": int(round(cyc['Val'].mean())),
+        "AvgConc": round(cyc['Conc'].mean() if not cyc['Conc'].isna().all() else 0, 2),
+        "grid": grid, "csum": np.concatenate([[0.0], np.cumsum(grid)])
+    }
+
+
+def score_cycles(index, target_t, min_m):
+    """History dicts for one Target Temp / Target Duration from a build_cycle_index() result"""
+    history = []
+    for c in index:
+        k     = np.searchsorted(c["grid"], target_t, 'left')   # first 10 s sample >= target
+        n_up  = len(c["grid"]) - k
+        acc   = n_up * (10 / 60)
+        history.append({
+            "No": c["No"], "Start": c["Start"], "End": c["End"], "StartTime": c["StartTime"],
+            "TotalDuration": c["TotalDuration"],
+            "TimeAboveTarget": int(round(acc)),
+            "MaxTemp": c["MaxTemp"], "AvgTemp": c["AvgTemp"],
+            "AvgTempTarget": int(round((c["csum"][-1] - c["csum"][k]) / n_up if n_up else 0)),
+            "AvgConc": c["AvgConc"],
+            "Status": "PASS" if acc >= min_m else "FAIL"
+        })
+    return history
+
+
+def process_logic(temp_df, conc_df, target_t, min_m):
+    return score_cycles(build_cycle_index(temp_df, conc_df), target_t, min_m)
+
+
+# ============================================================
+# CYCLE TABLE — one columnar history per run
+# ============================================================
+class CycleTable:
+    """{(factory, tank): cycle index} as flat typed columns.
+
+    Factory/Tank are categoricals, Start/End int64 ns, the fixed metrics small ints,
+    and the 10 s grids of all cycles one float64 array (+ one array of their prefix
+    sums), so score() is a handful of NumPy passes for any number of cycles.
+    """
+    def __init__(self, index, factories=None, tanks=None):
+        keys = [k for k, idx in index.items() if idx]
+        recs = [(k, c) for k in keys for c in index[k]]
+        n    = len(recs)
+        fac  = factories or list(dict.fromkeys(k[0] for k in keys))
+        tnk  = tanks or list(dict.fromkeys(k[1] for k in keys))
+        ns   = lambda key: np.fromiter((c[key].value for _, c in recs), 'int64', n)
+        self.cols = pd.DataFrame({
+            "Factory": pd.Categorical([k[0] for k, _ in recs], categories=fac),
+            "Tank":    pd.Categorical([k[1] for k, _ in recs], categories=tnk),
+            "No":      np.fromiter((c["No"] for _, c in recs), 'int32', n),
+            "Start":   ns("Start"), "End": ns("End"),
+            "TotalDuration": np.fromiter((c["TotalDuration"] for _, c in recs), 'int32', n),
+            "MaxTemp": np.fromiter((c["MaxTemp"] for _, c in recs), 'int16', n),
+            "AvgTemp": np.fromiter((c["AvgTemp"] for _, c in recs), 'int16', n),
+            "AvgConc": np.fromiter((c["AvgConc"] for _, c in recs), 'float32', n),
+        })
+        self.n_grid = np.fromiter((len(c["grid"]) for _, c in recs), 'int64', n)
+        self.grid   = np.concatenate([c["grid"] for _, c in recs]) if n else np.empty(0)
+        self.csum   = np.concatenate([c["csum"] for _, c in recs]) if n else np.zeros(0)
+        self.seg    = np.repeat(np.arange(n), self.n_grid)              # cycle of each grid sample
+        self.c_end  = np.cumsum(self.n_grid + 1) - 1                    # csum[-1] of each cycle
+
+    def __len__(self):
+        return len(self.cols)
+
+    def score(self, target_t, min_m):
+        """Columns + TimeAboveTarget / AvgTempTarget / Pass — same numbers as score_cycles"""
+        n_up = np.bincount(self.seg, weights=self.grid >= target_t, minlength=len(self)).astype('int64')
+        acc  = n_up * (10 / 60)
+        k    = self.c_end - n_up                                          # csum[k] of score_cycles
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = np.where(n_up > 0, (self.csum[self.c_end] - self.csum[k]) / np.maximum(n_up, 1), 0.0)
+        return self.cols.assign(TimeAboveTarget=np.round(acc).astype('int32'),
+                                AvgTempTarget=np.round(avg).astype('int16'),
+                                Pass=acc >= min_m)
+
+
+def pass_rates(scored, by):
+    """Total / Pass / %Pass per group of a CycleTable.score() frame; "Month" in `by` groups by calendar month"""
+    keys = [scored["Start"].to_numpy().astype('datetime64[ns]').astype('datetime64[M]') if b == "Month"
+            else scored[b] for b in by]
+    g = scored["Pass"].groupby(keys, observed=True, sort=True).agg(["size", "sum"])
+    g.index.names = by
+    out = pd.DataFrame({"Total": g["size"].astype('int32'), "Pass": g["sum"].astype('int32')})
+    out["%Pass"] = (out["Pass"] / out["Total"] * 100).round(1)
+    return out
+
+
+# ============================================================
+# LIVE — build_cycle_index as a state machine fed poll by poll
+# ============================================================
+class CycleTracker:
+    """Incremental build_cycle_index for one tank.
+
+    feed() takes only the points recorded since the previous call; the trigger state,
+    the merged cycle in progress and its rows are carried between calls, so a feed
+    costs O(new points + rows of the open cycle) whatever the history length.
+    A cycle is final (appended to .index) once GAP_MIN has passed below trigger
+    without a new rise — the same periods build_cycle_index finds on the full series.
+    """
+    def __init__(self, has_conc=True):
+        self.has_conc = has_conc
+        self.index    = []      # finished cycles, build_cycle_index records
+        self.no       = 0       # merged periods seen so far ("No", filtered ones included)
+        self.above    = False   # last non-NaN Val > TRIGGER_TEMP
+        self.start = self.end = None   # merged cycle in progress; end is None while above trigger
+        self.rows     = None    # its Time/Val/Conc rows (from start)
+        self.conc     = pd.DataFrame({'Time': pd.Series(dtype='datetime64[ns]'), 'Conc': pd.Series(dtype='float64')})
+        self.last_t = self.last_v = None
+
+    @property
+    def running(self):
+        return self.start is not None and self.end is None
+
+    def feed(self, temp_df, conc_df=None):
+        """Add new points; returns the cycles finished by them"""
+        if conc_df is not None and not conc_df.empty:
+            new_c = conc_df[['Time', 'Val']].rename(columns={'Val': 'Conc'})
+            if len(self.conc): new_c = new_c[new_c['Time'] > self.conc['Time'].iloc[-1]]
+            self.conc = pd.concat([self.conc, new_c], ignore_index=True) if len(self.conc) else new_c
+        if temp_df.empty: return []
+        new = temp_df[['Time', 'Val']].sort_values('Time', kind='stable')
+        if self.last_t is not None: new = new[new['Time'] > self.last_t]
+        if new.empty: return []
+
+        rows = (pd.merge_asof(new, self.conc, on='Time', direction='backward')
+                if self.has_conc else new.assign(Conc=0))
+        t = rows['Time'].to_numpy('datetime64[ns]')
+        v = rows['Val'].to_numpy('float64')
+        self.last_t = pd.Timestamp(t[-1])
+        # the conc tail only needs the last point at or before last_t
+        keep = max(int(np.searchsorted(self.conc['Time'].to_numpy('datetime64[ns]'), t[-1], 'right')) - 1, 0)
+        self.conc = self.conc.iloc[keep:]
+
+        ok = ~np.isnan(v)
+        if ok.any(): self.last_v = float(v[ok][-1])
+        step = np.diff((v[ok] > TRIGGER_TEMP).astype(np.int8), prepend=np.int8(self.above))
+        edges = np.flatnonzero(step)
+        if self.start is not None or len(edges):
+            self.rows = pd.concat([self.rows, rows], ignore_index=True) if self.rows is not None else rows
+
+        gap, done = np.timedelta64(GAP_MIN * 60, 's'), []
+        for i in edges:
+            te = t[ok][i]
+            if step[i] == 1:
+                if self.start is not None and te - self.end.to_datetime64() > gap:
+                    done += self._close()
+                if self.start is None:
+                    self.no += 1; self.start = pd.Timestamp(te)
+                    base = self.rows if self.rows is not None else rows
+                    self.rows = base[base['Time'] >= self.start]
+                self.end = None
+            else:
+                self.end = pd.Timestamp(te)
+            self.above = step[i] == 1
+        if self.start is not None and self.end is not None and self.last_t - self.end >= pd.Timedelta(gap):
+            done += self._close()
+        return done
+
+    def _close(self):
+        rec = self.current(MIN_DURATION)
+        self.start = self.end = self.rows = None
+        if rec: self.index.append(rec)
+        return [rec] if rec else []
+
+    def current(self, min_duration=0):
+        """Record of the cycle in progress (End = latest point while still above trigger), or None"""
+        if self.start is None: return None
+        end = self.end if self.end is not None else self.last_t
+        t = self.rows['Time'].to_numpy('datetime64[ns]')
+        return _cycle_record(self.no, self.start, end,
+                             self.rows.iloc[:np.searchsorted(t, end.to_datetime64(), 'right')], min_duration)
+
+
+# ============================================================
+# PROCESS POOL — index big tanks off the Streamlit thread / GIL
+# ============================================================
+ANALYSIS_WORKERS   = min(8, os.cpu_count() or 1)
+PROCESS_MIN_POINTS = 100_000   # smaller tanks are indexed in-process (pool overhead > gain)
+
+_pool, _pool_lock = None, threading.Lock()
+
+
+def _process_pool(workers):
+    """One spawn-based pool per server process, kept across reruns"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != workers:
+            if _pool is not None: _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _pack(df):
+    """Time/Val frame → (int64 ns, float) arrays — what crosses the process boundary"""
+    if df.empty: return np.empty(0, 'int64'), np.empty(0, 'float32')
+    return df['Time'].to_numpy('datetime64[ns]').view('int64'), df['Val'].to_numpy()
+
+
+def _index_arrays(tt, tv, ct, cv):
+    return build_cycle_index(pd.DataFrame({'Time': tt.view('datetime64[ns]'), 'Val': tv}),
+                             pd.DataFrame({'Time': ct.view('datetime64[ns]'), 'Val': cv}))
+
+
+def submit_cycle_index(temp_df, conc_df, thread_pool=None, workers=ANALYSIS_WORKERS):
+    """Future of build_cycle_index(temp_df, conc_df).
+
+    Big tanks go to the process pool as plain arrays; small ones run on `thread_pool`
+    (or inline when there is none).
+    """
+    if workers > 1 and len(temp_df) >= PROCESS_MIN_POINTS:
+        try:
+            return _process_pool(workers).submit(_index_arrays, *_pack(temp_df), *_pack(conc_df))
+        except Exception:   # pool broken or shutting down — fall back to in-process
+            global _pool
+            _pool = None
+    if thread_pool is not None:
+        return thread_pool.submit(build_cycle_index, temp_df, conc_df)
+    fut = concurrent.futures.Future()
+    try: fut.set_result(build_cycle_index(temp_df, conc_df))
+    except Exception as e: fut.set_exception(e)
+    return fut
+
+
+def build_cycle_indexes(jobs, workers=ANALYSIS_WORKERS):
+    """{key: (temp_df, conc_df)} → {key: cycle index}"""
+    futs = {k: submit_cycle_index(t, c, workers=workers) for k, (t, c) in jobs.items()}
+    return {k: f.result() for k, f in futs.items()}
+
+
+if __name__ == "__main__":
+    # scaling check on synthetic tanks: python cip_analysis.py [tanks] [days]
+    import sys, time
+    n_tanks, days = (int(x) for x in (sys.argv[1:] + ["8", "60"])[:2])
+    rng = np.random.default_rng(0)
+    t = pd.date_range("2026-01-01", periods=days * 8640, freq="10s")
+    jobs = {}
+    for k in range(n_tanks):
+        v = 30 + 45 * ((np.arange(len(t)) // 360 + k) % 16 == 0) + rng.normal(0, 0.5, len(t))
+        jobs[k] = (pd.DataFrame({'Time': t, 'Val': v.astype('float32')}), pd.DataFrame(columns=['Time', 'Val']))
+    for w in (1, 2, 4, 8):
+        if w > 1: _process_pool(w).submit(int).result()   # pool start-up is not part of the timing
+        t0 = time.perf_counter(); build_cycle_indexes(jobs, workers=w)
+        print(f"workers={w}: {time.perf_counter() - t0:.2f}s ({n_tanks} tanks x {len(t):,} pts)")
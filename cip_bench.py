@@ -0,0 +1,304 @@
+"""
+CIP benchmark — fake PI Web API + synthetic CIP signals + timed scenarios
+=========================================================================
+    python cip_bench.py --ranges 1 30 365 --out bench.jsonl
+    python cip_bench.py --compare bench_before.jsonl bench.jsonl
+
+- FakePI: local /points, /streams/{webid}/recorded and /batch with latency, error rate, point density
+- cip_signal(): tank temperatures with CIP plateaus, sub-15-min spikes and dips around GAP_MIN
+- One JSON line per scenario run (scenario, engine, range, cache state, seconds, points, requests)
+Runs on its own temporary cache directory; the real .cip_cache is never touched.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import numpy as np
+import orjson
+import pandas as pd
+
+# cip_data reads its cache location on import — point it at a scratch directory first
+assert "cip_data" not in sys.modules, "import cip_bench before cip_data"
+BENCH_CACHE = os.environ["CIP_CACHE_DIR"] = tempfile.mkdtemp(prefix="cip_bench_")
+
+import cip_data
+from cip_analysis import TRIGGER_TEMP, GAP_MIN, build_cycle_index, build_cycle_indexes, process_logic
+from cip_data import (FACTORY_CONFIG, DISK_INDEX, SHARED_FRAMES, init_cache, PIClient, AsyncPIClient, pi_event_loop,
+                      get_data_pi, fetch_batch, analyse_plant, pi_traffic)
+from requests.auth import HTTPBasicAuth
+
+
+BENCH_END = date(2026, 1, 1)   # ranges end here (a past day: every day is complete → reproducible)
+SLOT_H    = 8                  # one event (or none) per tank per 8 h slot
+
+
+# ============================================================
+# SYNTHETIC SIGNALS
+# ============================================================
+def _noise(t_s, seed):
+    """Deterministic noise in [-0.5, 0.5) per timestamp (same value whatever range is asked)"""
+    x = np.sin(t_s * 12.9898 + seed % 1000 * 78.233) * 43758.5453
+    return x - np.floor(x) - 0.5
+
+
+def cip_signal(tag, t_ns):
+    """Values of `tag` at UTC epoch ns `t_ns` (sorted). Temperature tags: ambient 28–35 °C with
+    CIP plateaus (25–70 min at 60–85 °C), short spikes above TRIGGER_TEMP (< 15 min) and
+    plateaus split by a dip of GAP_MIN ± 10 min. Tags ending in "CIP" give %CIP (0–2)."""
+    seed = zlib.crc32(tag.encode())
+    t_s  = t_ns // 10**9
+    conc = tag.upper().endswith("CIP")
+    v = (0.05 if conc else 28 + seed % 7) + _noise(t_s, seed) * (0.02 if conc else 0.6)
+    if not len(t_s): return v
+    slot = SLOT_H * 3600
+    for k in range(int(t_s[0]) // slot, int(t_s[-1]) // slot + 1):
+        rng = np.random.default_rng([seed, k])
+        kind, start = rng.random(), k * slot + rng.uniform(0, slot - 3 * 3600)
+        if kind < 0.35:     # one CIP plateau
+            events = [(start, rng.uniform(25, 70) * 60)]
+        elif kind < 0.50:   # two plateaus around the GAP_MIN merge limit
+            first, gap = rng.uniform(15, 40) * 60, (GAP_MIN + rng.uniform(-10, 10)) * 60
+            events = [(start, first), (start + first + gap, rng.uniform(15, 40) * 60)]
+        elif kind < 0.70:   # short spike, must not count as a cycle
+            events = [(start, rng.uniform(2, 14) * 60)]
+        else:
+            continue
+        level = rng.uniform(1.2, 2.0) if conc else (rng.uniform(60, 85) if kind < 0.5 else rng.uniform(45, 60))
+        for s, d in events:
+            i0, i1 = np.searchsorted(t_s, [s, s + d])
+            if i1 <= i0: continue
+            ramp = np.minimum(1, np.minimum(t_s[i0:i1] - s, s + d - t_s[i0:i1]) / 180)   # 3 min ramps
+            base = 0.05 if conc else TRIGGER_TEMP - 5
+            v[i0:i1] = np.maximum(v[i0:i1], base + (level - base) * ramp)
+    return v
+
+
+def synthetic_frame(tag, start, end, step=10):
+    """Time/Val frame of cip_signal over whole days start..end (local Time, like get_data_pi)"""
+    t0 = pd.Timestamp(start).value
+    t_ns = np.arange(t0, pd.Timestamp(end + timedelta(days=1)).value, step * 10**9, dtype='int64')
+    local = pd.to_datetime(t_ns, utc=True).tz_convert('Asia/Bangkok').tz_localize(None)
+    return pd.DataFrame({'Time': local, 'Val': cip_signal(tag, t_ns).astype('float32')})
+
+
+# ============================================================
+# FAKE PI WEB API
+# ============================================================
+class FakePI:
+    """Local stand-in for the PI Web API calls the app makes"""
+    def __init__(self, step=10, latency=0.0, error_rate=0.0, seed=0):
+        self.step, self.latency, self.error_rate = step, latency, error_rate
+        self.requests = self.errors = self.points = 0
+        self._rng, self._lock = np.random.default_rng(seed), threading.Lock()
+        self.server = self.url = None
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like the real server
+            def log_message(self, *a): pass
+            def do_GET(self):  self._reply(*fake.handle("GET", self.path))
+            def do_POST(self):
+                self._reply(*fake.handle("POST", self.path, self.rfile.read(int(self.headers["Content-Length"]))))
+            def _reply(self, code, body, headers=()):
+                data = orjson.dumps(body) if body is not None else b""
+                self.send_response(code)
+                for k, v in headers: self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers(); self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/piwebapi"
+        return self
+
+    def stop(self):
+        self.server.shutdown(); self.server.server_close()
+
+    def handle(self, method, path, body=None):
+        with self._lock:
+            self.requests += 1
+            fail = self._rng.random() < self.error_rate
+        if self.latency: time.sleep(self.latency)
+        if fail:
+            with self._lock: self.errors += 1
+            return 503, None, [("Retry-After", "0")]
+        if method == "POST":
+            return 207, self._batch(orjson.loads(body))
+        return self._get(path)
+
+    def _get(self, path):
+        u = urlparse(path); q = dict(parse_qsl(u.query))
+        if u.path.endswith("/points"):
+            return 200, {"WebId": "W" + q["path"].rsplit("\\", 1)[-1]}
+        if u.path.endswith("/recorded"):
+            return 200, {"Items": self._recorded(u.path.split("/")[-2][1:], q)}
+        return 404, {}
+
+    def _recorded(self, tag, q):
+        step = self.step * 10**9
+        t0, t1 = (pd.Timestamp(q[k]).value for k in ("startTime", "endTime"))
+        first = -(-t0 // step) * step
+        t_ns = np.arange(first, t1 + 1, step, dtype='int64')[:int(q.get("maxCount", 1000))]
+        with self._lock: self.points += len(t_ns)
+        stamps = np.datetime_as_string(t_ns.astype('datetime64[ns]'), unit='s')
+        vals = cip_signal(tag, t_ns)
+        return [{"Timestamp": s + "Z", "Value": float(v), "Good": True, "Questionable": False,
+                 "Substituted": False} for s, v in zip(stamps.tolist(), vals.tolist())]
+
+    def _batch(self, reqs):
+        out = {}
+        for key, r in reqs.items():   # PI resolves ParentIds first; dict order already does here
+            res = r["Resource"]
+            if "Parameters" in r:
+                parent = out[r["Parameters"][0].split(".")[1]]
+                if parent["Status"] != 200: out[key] = {"Status": 409, "Content": {}}; continue
+                res = res.replace("{0}", parent["Content"]["WebId"])
+            code, content = self._get(res[res.index("/piwebapi"):])
+            out[key] = {"Status": code, "Headers": {}, "Content": content}
+        return out
+
+
+# ============================================================
+# SCENARIOS
+# ============================================================
+def _reset(cache):
+    """cold: nothing cached, WebIds unknown · disk: day files only · memory: everything warm"""
+    if cache == "cold":
+        DISK_INDEX.remove(None)
+        try: os.remove(cip_data.WEBID_FILE)
+        except OSError: pass
+    if cache in ("cold", "disk"):
+        SHARED_FRAMES.clear()
+
+
+def _client(engine, cache, clients):
+    if cache == "cold" or engine not in clients:
+        auth = HTTPBasicAuth("bench", "bench")
+        clients[engine] = AsyncPIClient(auth, pi_event_loop()) if engine == "async" else PIClient(auth)
+    return clients[engine]
+
+
+def run_analysis(days, step):
+    """process_logic vs build_cycle_index on one synthetic tank"""
+    start = BENCH_END - timedelta(days=days - 1)
+    temp = synthetic_frame("BENCH-TANK", start, BENCH_END, step)
+    conc = synthetic_frame("BENCH-CIP", start, BENCH_END, step)
+    out = []
+    for name, fn in (("process_logic", lambda: process_logic(temp, conc, 70.0, 40.0)),
+                     ("build_cycle_index", lambda: build_cycle_index(temp, conc))):
+        t0 = time.perf_counter(); res = fn()
+        out.append({"scenario": f"analysis/{name}", "seconds": time.perf_counter() - t0,
+                    "points": len(temp) + len(conc), "cycles": len(res)})
+    return out
+
+
+def run_fetch(fake, scenario, engine, cache, days, clients):
+    """One timed fetch (+ indexing for factory/plant) against the fake server"""
+    start = BENCH_END - timedelta(days=days - 1)
+    factories = (FACTORY_CONFIG if scenario == "plant" else
+                 {"DC": FACTORY_CONFIG["DC"]} if scenario == "factory" else None)
+    _reset(cache)
+    client = _client(engine, cache, clients)
+    req0, pts0 = fake.requests, fake.points
+    t0 = time.perf_counter()
+    if scenario == "tag":
+        dfs, tanks = [get_data_pi(FACTORY_CONFIG["DC"]["tags"]["R421"], client, start, BENCH_END)], 1
+    elif engine == "batch":
+        frames, _ = fetch_batch({(f, k): tag for f, c in factories.items()
+                                 for k, tag in {**c["tags"], "_conc": c["cip_tag"]}.items()}, client, start, BENCH_END)
+        concs = {f: frames.pop((f, "_conc")) for f in factories}
+        jobs  = {(f, k): (df, concs[f]) for (f, k), df in frames.items() if not df.empty}
+        build_cycle_indexes(jobs, 1)
+        dfs, tanks = list(frames.values()) + list(concs.values()), len(jobs)
+    else:
+        dfs, tanks = [], 0
+        for _, _, kind, _, _, payload in analyse_plant(factories, client, start, BENCH_END):
+            if kind in ("temp", "conc"): dfs.append(payload)
+            elif kind == "index": tanks += 1
+    seconds = time.perf_counter() - t0
+    pages, pi_points = pi_traffic(*dfs)
+    return {"scenario": scenario, "engine": engine, "cache": cache, "seconds": seconds,
+            "tanks": tanks, "points": sum(len(d) for d in dfs), "pi_points": pi_points, "pi_pages": pages,
+            "requests": fake.requests - req0, "server_points": fake.points - pts0}
+
+
+def _rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(before, after, tolerance, min_delta=0.01):
+    """Print seconds per scenario key for two result files; True when nothing got slower than
+    tolerance× (differences under min_delta seconds are timer noise)"""
+    key = lambda r: (r["scenario"], r.get("engine"), r.get("cache"), r["days"])
+    load = lambda p: {key(r): r["seconds"] for r in map(json.loads, open(p, encoding="utf-8"))}
+    a, b, ok = load(before), load(after), True
+    for k in sorted(set(a) & set(b), key=str):
+        ratio = b[k] / a[k] if a[k] else float("inf")
+        flag = "  ← slower" if ratio > tolerance and b[k] - a[k] > min_delta else ""
+        ok &= not flag
+        print(f"{'/'.join(str(x) for x in k if x is not None):40s} {a[k]:9.3f}s → {b[k]:9.3f}s  ×{ratio:5.2f}{flag}")
+    return ok
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--ranges", type=int, nargs="+", default=[1, 30], help="range lengths in days (default 1 30)")
+    ap.add_argument("--scenarios", nargs="+", default=["analysis", "tag", "factory", "plant"],
+                    choices=["analysis", "tag", "factory", "plant"])
+    ap.add_argument("--engines", nargs="+", default=["thread"], choices=["thread", "async", "batch"])
+    ap.add_argument("--caches", nargs="+", default=["cold", "disk", "memory"], choices=["cold", "disk", "memory"])
+    ap.add_argument("--step", type=int, default=10, help="seconds between points (default 10)")
+    ap.add_argument("--latency", type=float, default=0.05, help="fake PI latency per request, s")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    ap.add_argument("--out", help="append JSON lines here (default: stdout)")
+    ap.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    ap.add_argument("--tolerance", type=float, default=1.2, help="--compare: slower than this ratio fails")
+    args = ap.parse_args(argv)
+    if args.compare: return 0 if compare(*args.compare, args.tolerance) else 1
+
+    init_cache()   # BENCH_CACHE, never the real .cip_cache
+    fake = FakePI(args.step, args.latency, args.error_rate).start()
+    cip_data.PI_BASE = fake.url
+    meta = {"run": time.strftime("%Y-%m-%dT%H:%M:%S"), "rev": _rev(), "python": platform.python_version(),
+            "cpus": os.cpu_count(), "step": args.step, "latency": args.latency, "error_rate": args.error_rate}
+    out = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    clients = {}
+    try:
+        for days in args.ranges:
+            rows = run_analysis(days, args.step) if "analysis" in args.scenarios else []
+            for scenario in (s for s in args.scenarios if s != "analysis"):
+                for engine in args.engines:
+                    if engine == "batch" and scenario == "tag": continue
+                    for cache in args.caches:
+                        rows.append(run_fetch(fake, scenario, engine, cache, days, clients))
+            for row in rows:
+                out.write(json.dumps({**meta, "days": days, **row}) + "\n"); out.flush()
+    finally:
+        fake.stop()
+        if out is not sys.stdout: out.close()
+        shutil.rmtree(BENCH_CACHE, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1328 @@
+"""
+CIP data layer — factory/tag config, PI Web API client, day cache and the fetch pipeline.
+Shared by the Streamlit dashboard (CIP_Time.py) and the headless precompute job
+(cip_precompute.py); no Streamlit dependency.
+"""
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import requests
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
+from cip_analysis import submit_cycle_index
+from cip_metrics import METRICS
+import urllib3
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import time
+import pickle
+import os
+import re
+import hashlib
+import json
+import orjson
+import threading
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlencode
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest   # ships with Streamlit
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+FACTORY_CONFIG = {
+    "PK1": {
+        "tags": {
+            "R421": "BEB1-10-0400A-TI421", "R422": "BEB1-10-0400A-TI422",
+            "R423": "BEB1-10-0400A-TI423", "R424B": "BEB1-10-0400A-TI424B",
+            "R424": "BEB1-10-0400A-TI424", "R425": "BEB1-10-0400A-TI425",
+            "R426": "BEB1-10-0400A-TI426"
+        },
+        "cip_tag": None
+    },
+    "PK2": {
+        "tags": {
+            "R421": "BEB1-10-0400B-TT421", "R422": "BEB1-10-0400B-TT422",
+            "R423": "BEB1-10-0400B-TT423", "R423B": "BEB1-10-0400B-TT423B",
+            "R424": "BEB1-10-0400B-TT424", "R425": "BEB1-10-0400B-TT425",
+            "R426": "BEB1-10-0400B-TT426"
+        },
+        "cip_tag": None
+    },
+    "KN": {
+        "tags": {
+            "R421": "OEO1-10-0400-TT421", "R422": "OEO1-10-0400-TT422",
+            "R423": "OEO1-10-0400-TT423", "R424": "OEO1-10-0400-TT424",
+            "R425": "OEO1-10-0400-TT425", "R426": "OEO1-10-0400-TT426",
+            "R427": "OEO1-10-0400-TT427"
+        },
+        "cip_tag": None
+    },
+    "DC": {
+        "tags": {
+            "R421": "BEB3-10-0400-TT421", "R422": "BEB3-10-0400-TT422B",
+            "R423": "BEB3-10-0400-TT423B", "R424": "BEB3-10-0400-TT424B",
+            "R425": "BEB3-10-0400-TT425B", "R426": "BEB3-10-0400-TT426B",
+            "R427": "BEB3-10-0400-TT427B"
+        },
+        "cip_tag": "BEB3-57-0100-CIP"
+    },
+    "MCE": {
+        "tags": {
+            "R421": "CEC1-10-0400-TI421", "R422": "CEC1-10-0400-TI422",
+            "R423": "CEC1-10-0400-TI423", "R424": "CEC1-10-0400-TI424",
+            "R425": "CEC1-10-0400-TI425", "R426": "CEC1-10-0400-TI426"
+        },
+        "cip_tag": None
+    }
+}
+
+# Cache stored in same folder as script (CIP_CACHE_DIR / CIP_PI_BASE override for jobs and benchmarks)
+CACHE_DIR = os.environ.get("CIP_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cip_cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_TTL_HOURS = 6
+CACHE_TAIL_MIN  = 5    # incremental mode: top up today's tail after this many minutes
+SHARED_CACHE_MB = 1024 # in-memory frames shared by all sessions (LRU above this)
+CACHE_MAX_MB    = 2048 # disk budget for .cip_cache day files (LRU above this)
+CACHE_IDLE_DAYS = 180  # day files not read for this long are swept
+CACHE_SWEEP_MIN = 10   # background sweep interval
+
+
+# ============================================================
+# DISK CACHE — one columnar file per tag per UTC calendar day
+# ============================================================
+# A day whose file was written after the day ended is complete and never expires.
+# Today (or a day fetched before it was over) is stale after ttl_hours and gets
+# refetched — or, in incremental mode, topped up from its last cached Time.
+# Files are uncompressed Feather (Arrow IPC): Time = int64 UTC epoch ns, Val = float32,
+# Q = uint8 PI quality bits (Q_* below; 0 = good, files from before Q read as 0),
+# sorted by Time, so a memory-mapped read only touches the rows it slices.
+Q_BAD, Q_QUESTIONABLE, Q_SUBSTITUTED, Q_STATE = 1, 2, 4, 8   # Q_STATE: digital/system state code
+
+def _as_date(d):
+    if isinstance(d, datetime): return d.date()
+    if hasattr(d, 'strftime'):  return d
+    return datetime.strptime(str(d)[:10], "%Y-%m-%d").date()
+
+def _day_end(day):
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() + 86400
+
+def _tag_dir(tag):
+    return os.path.join(CACHE_DIR, re.sub(r'[^\w.-]', '_', tag))
+
+def _day_path(tag, day):
+    return os.path.join(_tag_dir(tag), f"{day:%Y-%m-%d}.feather")
+
+def _local_times(t_ns):
+    """UTC epoch ns → naive Asia/Bangkok datetimes (the Time column used everywhere)"""
+    return pd.to_datetime(t_ns, utc=True).tz_convert('Asia/Bangkok').tz_localize(None)
+
+def _utc_ns(times):
+    return pd.DatetimeIndex(times).tz_localize('Asia/Bangkok').tz_convert('UTC').as_unit('ns').asi8
+
+def _col(tbl, name):
+    c = tbl.column(name)
+    return c.chunk(0).to_numpy() if c.num_chunks == 1 else c.to_numpy()
+
+def _read_day(fpath, lo=None, hi=None):
+    """Time/Val/Q frame from one day file; lo/hi (UTC ns) slice it without reading the rest"""
+    tbl = feather.read_table(fpath, memory_map=True)
+    t = _col(tbl, 'Time')
+    i0 = 0 if lo is None else np.searchsorted(t, lo, 'left')
+    i1 = len(t) if hi is None else np.searchsorted(t, hi, 'right')
+    if i1 <= i0: return pd.DataFrame(columns=['Time', 'Val'])
+    # copy out of the map so the file is not held open (Windows cannot replace a mapped file)
+    q = np.array(_col(tbl, 'Q')[i0:i1]) if 'Q' in tbl.column_names else np.zeros(i1 - i0, 'uint8')
+    return pd.DataFrame({'Time': _local_times(t[i0:i1]), 'Val': np.array(_col(tbl, 'Val')[i0:i1]), 'Q': q})
+
+def _write_day(fpath, df):
+    t = _utc_ns(df['Time']) if not df.empty else np.empty(0, 'int64')
+    v = df['Val'].to_numpy('float32') if not df.empty else np.empty(0, 'float32')
+    q = df['Q'].to_numpy('uint8') if 'Q' in df.columns else np.zeros(len(t), 'uint8')
+    tmp = f"{fpath}.{threading.get_ident()}.tmp"
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    feather.write_feather(pa.table({'Time': t, 'Val': v, 'Q': q}), tmp, compression='uncompressed')
+    os.replace(tmp, fpath)   # readers never see a half-written file
+
+def _load_day(tag, day, ttl_hours=CACHE_TTL_HOURS):
+    """(frame, fresh) for one cached day — frame is None when nothing usable is on disk"""
+    fpath = _day_path(tag, day)
+    if not os.path.exists(fpath): return None, False
+    try: df = _read_day(fpath)
+    except: return None, False
+    DISK_INDEX.touch(fpath)
+    mtime, now = os.path.getmtime(fpath), time.time()
+    fresh = mtime >= _day_end(day) or (now < _day_end(day) and (now - mtime) / 3600 <= ttl_hours)
+    return df, fresh
+
+def _save_day(tag, day, df):
+    fpath = _day_path(tag, day)
+    try:
+        _write_day(fpath, df)
+        DISK_INDEX.touch(fpath, tag, day, os.path.getsize(fpath))
+    except: pass
+
+# ------------------------------------------------------------
+# index.json (day file → tag, day, bytes, last access) + LRU budget + background sweep
+# ------------------------------------------------------------
+class DiskCacheIndex:
+    def __init__(self, root, max_bytes):
+        self.root, self.max_bytes = root, max_bytes
+        self.path  = os.path.join(root, "index.json")
+        self._lock, self._dirty, self.wake = threading.Lock(), False, threading.Event()
+        try:
+            with open(self.path, encoding="utf-8") as f: self.entries = json.load(f)
+        except: self.entries = {}
+        self.bytes = sum(e.get("bytes", 0) for e in self.entries.values())
+
+    def touch(self, fpath, tag=None, day=None, nbytes=None):
+        """Record a read (last access) or, with nbytes, a write"""
+        rel = os.path.relpath(fpath, self.root)
+        with self._lock:
+            e = self.entries.get(rel)
+            if e is None:
+                if nbytes is None: return   # not indexed yet — the next sweep picks it up
+                e = self.entries[rel] = {"tag": tag, "day": f"{day:%Y-%m-%d}", "bytes": 0}
+            if nbytes is not None:
+                self.bytes += nbytes - e["bytes"]; e["bytes"] = nbytes
+            e["atime"], self._dirty = time.time(), True
+            if self.bytes > self.max_bytes: self.wake.set()
+
+    def remove(self, tags=None):
+        """Delete the day files of `tags` (all when None); returns the number of files removed"""
+        dirs = None if tags is None else {os.path.relpath(_tag_dir(t), self.root) for t in tags}
+        n = 0
+        for root, _, files in os.walk(self.root):
+            rel_dir = os.path.relpath(root, self.root)
+            if dirs is not None and rel_dir not in dirs: continue
+            for f in files:
+                if f.endswith((".feather", ".pkl", ".pickle")):
+                    try: os.remove(os.path.join(root, f)); n += 1
+                    except: pass
+        with self._lock:
+            for rel in [r for r in self.entries if dirs is None or os.path.dirname(r) in dirs]:
+                self.bytes -= self.entries.pop(rel)["bytes"]
+            self._dirty = True
+        self.flush()
+        return n
+
+    def sweep(self):
+        """Reconcile with the directory, drop idle files, evict LRU down to 90% of the budget"""
+        now, seen = time.time(), {}
+        for root, _, files in os.walk(self.root):
+            if root == self.root: continue
+            for f in files:
+                fpath = os.path.join(root, f)
+                try:
+                    st_ = os.stat(fpath)
+                    if f.endswith(".tmp") and now - st_.st_mtime > 3600: os.remove(fpath)   # crashed writer
+                    elif f.endswith(".feather"): seen[os.path.relpath(fpath, self.root)] = st_
+                except OSError: pass
+        with self._lock:
+            for rel in [r for r in self.entries if r not in seen]: del self.entries[rel]
+            for rel, st_ in seen.items():
+                e = self.entries.setdefault(rel, {"tag": os.path.dirname(rel), "day": os.path.basename(rel)[:10],
+                                                  "atime": st_.st_mtime})
+                e["bytes"] = st_.st_size
+            idle  = [r for r, e in self.entries.items() if now - e["atime"] > CACHE_IDLE_DAYS * 86400]
+            lru   = sorted((r for r in self.entries if r not in idle), key=lambda r: self.entries[r]["atime"])
+            total = sum(e["bytes"] for r, e in self.entries.items() if r not in idle)
+            drop  = list(idle)
+            while lru and total > self.max_bytes * 0.9:
+                r = lru.pop(0); total -= self.entries[r]["bytes"]; drop.append(r)
+            for r in drop: del self.entries[r]
+            self.bytes, self._dirty = total, True
+        for r in drop:
+            try: os.remove(os.path.join(self.root, r))
+            except OSError: pass
+        self.flush()
+        return len(drop)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty: return
+            data, self._dirty = json.dumps(self.entries), False
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp, self.path)
+        except: pass
+
+    def run(self):
+        while True:
+            self.wake.wait(CACHE_SWEEP_MIN * 60); self.wake.clear()
+            try: self.sweep()
+            except Exception: pass
+
+
+# one index per process; importing this module never touches the cache directory —
+# the app / jobs call init_cache() to migrate old files and start the sweeper
+DISK_INDEX = DiskCacheIndex(CACHE_DIR, CACHE_MAX_MB * 2**20)
+_cache_started, _cache_lock = False, threading.Lock()
+
+
+def init_cache():
+    """Once per process: migrate .pkl cache files, then start the sweeper thread"""
+    global _cache_started
+    with _cache_lock:
+        if _cache_started: return DISK_INDEX
+        _migrate_cache()
+        threading.Thread(target=DISK_INDEX.run, name="cip-cache-sweeper", daemon=True).start()
+        DISK_INDEX.wake.set()   # first sweep right away: reconcile files written before the index existed
+        _cache_started = True
+    return DISK_INDEX
+
+
+def load_window(tag, start, end):
+    """Cached points of one tag between two local times, read by slicing the day files"""
+    lo, hi = _utc_ns([start, end])
+    d0, d1 = (pd.Timestamp(x).date() for x in (lo, hi))
+    parts = []
+    for i in range((d1 - d0).days + 1):
+        fpath = _day_path(tag, d0 + timedelta(days=i))
+        try: parts.append(_read_day(fpath, lo, hi))
+        except: pass
+    parts = [p for p in parts if not p.empty]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['Time', 'Val'])
+
+
+def load_days(tag, start_time, end_time):
+    """Cached points of the whole UTC days start..end (the range get_data_pi covers), no PI traffic"""
+    lo, hi = _local_times([pd.Timestamp(_as_date(start_time)).value,
+                           pd.Timestamp(_as_date(end_time) + timedelta(days=1)).value - 1])
+    return load_window(tag, lo, hi)
+
+
+def _legacy_days(key, df, mtime):
+    """Re-file one old range pickle (md5 of "{tag}_{start}_to_{end}") as day files"""
+    if df.empty: return
+    utc = _utc_ns(df['Time'])
+    first, last = pd.Timestamp(utc.min()).date(), pd.Timestamp(utc.max()).date()
+    tags = {t for c in FACTORY_CONFIG.values() for t in [*c["tags"].values(), c["cip_tag"]] if t}
+    for tag in tags:
+        for s_day in (first - timedelta(days=i) for i in range(8)):
+            for e_str in [f"{last + timedelta(days=i):%Y-%m-%d}" for i in range(8)] + ["now"]:
+                if hashlib.md5(f"{tag}_{s_day:%Y-%m-%d}_to_{e_str}".encode()).hexdigest() == key:
+                    e_day = (datetime.fromtimestamp(mtime, timezone.utc).date() if e_str == "now"
+                             else _as_date(e_str))
+                    # the last point's day may be cut short (old 50,000 maxCount or fetched mid-day)
+                    e_day = min(e_day, last - timedelta(days=1))
+                    days = [s_day + timedelta(days=i) for i in range((e_day - s_day).days + 1)]
+                    for d, part in _split_days(df.sort_values('Time'), days).items():
+                        fpath = _day_path(tag, d)
+                        if _day_end(d) <= mtime and not os.path.exists(fpath):   # only days complete back then
+                            _write_day(fpath, part); os.utime(fpath, (mtime, mtime))
+                    return
+
+
+def _migrate_cache():
+    """Once per process (from init_cache): pickled cache files (.pkl) → columnar day files"""
+    n = 0
+    for root, _, files in os.walk(CACHE_DIR):
+        for f in files:
+            if not f.endswith(".pkl"): continue
+            fpath = os.path.join(root, f)
+            try:
+                with open(fpath, "rb") as fh: df = pickle.load(fh)
+                mtime = os.path.getmtime(fpath)
+                if root == CACHE_DIR:   # range pickle from before the day cache
+                    _legacy_days(f[:-4], df, mtime)
+                else:                   # per-day pickle — keep its mtime (= completeness)
+                    new = fpath[:-4] + ".feather"
+                    if not os.path.exists(new):
+                        _write_day(new, df); os.utime(new, (mtime, mtime))
+                n += 1
+            except: pass
+            try: os.remove(fpath)
+            except: pass
+    return n
+
+
+# ============================================================
+# PI CLIENT — pooled session + persistent tag → WebId map
+# ============================================================
+PI_BASE = os.environ.get("CIP_PI_BASE", "https://piazu.mitrphol.com/piwebapi")
+
+PI_PAGE_SIZE = 50000   # maxCount per /recorded call — longer ranges are paged
+PI_WORKERS   = 16      # fetch threads = HTTP connection pool size = concurrency ceiling
+PI_MIN_CONCURRENCY, PI_START_CONCURRENCY = 1, 5   # AIMD limiter bounds (requests in flight to PI)
+PI_ASYNC_INFLIGHT = 64 # AIMD ceiling for the whole process (a thread client stops at its pool size)
+PI_BACKOFF_BASE, PI_BACKOFF_MAX = 1.0, 30.0       # seconds; jittered exponential backoff
+PI_RETRY_AFTER_MAX = 300   # s; a longer server Retry-After fails the request instead of waiting
+PI_BATCH_SIZE = 100    # sub-requests per /batch call
+PI_BUFFER_PAGES = 20   # first-page size estimate is capped at this many pages (buffer grows past it)
+WEBID_FILE   = os.path.join(CACHE_DIR, "webids.json")
+
+
+def _pi_path(tag_path):
+    return f"\\\\MPAZU-PIDCDB\\{tag_path}"
+
+
+class PIRetryable(Exception):
+    """Transient PI failure; `kind` is timeout / 429 / 5xx, `wait` the server's Retry-After (s)"""
+    def __init__(self, kind, msg, wait=None):
+        super().__init__(msg); self.kind, self.wait = kind, wait
+
+
+class AdaptiveLimiter:
+    """Process-wide cap on requests in flight to PI, adjusted AIMD-style:
+    +1 per window of clean responses, ×0.5 on timeout / 429 / 5xx / latency spike (once per window);
+    other failures (401, 404, bad request) say nothing about PI's load and leave the limit alone"""
+    def __init__(self, lo=PI_MIN_CONCURRENCY, hi=PI_WORKERS, start=PI_START_CONCURRENCY):
+        self.lo, self.hi, self.limit = lo, hi, float(start)
+        self.active, self.latency, self._cut_at = 0, {}, 0.0   # latency: EWMA per endpoint
+        self.ok = self.errors = 0
+        self._cv, self._loops = threading.Condition(), {}   # _loops: event loop → Event its coroutines wait on
+
+    def acquire(self):
+        with self._cv:
+            while self.active >= int(self.limit): self._cv.wait()
+            self.active += 1
+
+    async def acquire_async(self):
+        """acquire() for a coroutine: never blocks the loop thread, woken by any release in the process"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cv:
+                if self.active < int(self.limit):
+                    self.active += 1; return
+                freed = self._loops.setdefault(loop, asyncio.Event())
+            await freed.wait()
+
+    def release(self, endpoint, latency=None, error=False):
+        """error: True = congestion (cut), False = success (grow), None = neutral (just free the slot)"""
+        with self._cv:
+            self.active -= 1
+            if error is not None: self._adjust(endpoint, latency, error)
+            self._cv.notify_all()
+            loops, self._loops = self._loops, {}
+        for loop, freed in loops.items():
+            try: loop.call_soon_threadsafe(freed.set)
+            except RuntimeError: pass   # loop closed
+
+    def _adjust(self, endpoint, latency, error):
+        """AIMD step for one finished request (caller holds the lock)"""
+        now, avg = time.time(), self.latency.get(endpoint)
+        if latency is not None and not error:
+            error = avg is not None and latency > max(3 * avg, 2.0)
+            self.latency[endpoint] = latency if avg is None else 0.8 * avg + 0.2 * latency
+        if error:
+            self.errors += 1
+            if now - self._cut_at > (avg or 1.0):   # one cut per round trip, not per failure
+                self.limit, self._cut_at = max(self.lo, self.limit / 2), now
+        else:
+            self.ok += 1
+            self.limit = min(self.hi, self.limit + 1 / self.limit)
+
+
+# one limiter per process: every session, engine and tag shares PI's capacity
+PI_LIMITER = AdaptiveLimiter(hi=PI_ASYNC_INFLIGHT)
+
+
+def _outcome(ok, congested):
+    """limiter.release `error` for one request: only retryable failures count as congestion"""
+    return False if ok else (True if congested else None)
+
+
+def _backoff(attempt, wait=None):
+    """Full-jitter exponential backoff; Retry-After (when given) is the floor, never shortened"""
+    delay = np.random.uniform(0, min(PI_BACKOFF_MAX, PI_BACKOFF_BASE * 2 ** attempt))
+    return max(wait or 0, delay)
+
+
+def _give_up(attempt, max_retries, e):
+    return attempt >= max_retries or (e.wait or 0) > PI_RETRY_AFTER_MAX
+
+
+def _check_status(code, headers):
+    """Raise for a failed PI response (PIRetryable when trying again may help); True otherwise"""
+    if code == 429 or code >= 500:
+        try: wait = float(headers.get("Retry-After"))
+        except (TypeError, ValueError): wait = None
+        raise PIRetryable("429" if code == 429 else "5xx", f"HTTP {code}", wait)
+    if code == 401:
+        raise PermissionError("HTTP 401 — Incorrect Username or Password")
+    if code == 404:
+        raise LookupError("HTTP 404")
+    if code not in (200, 207):
+        raise ValueError(f"HTTP {code}")
+    return True
+
+
+def _json(body):
+    try: return orjson.loads(body)
+    except ValueError: raise PIRetryable("5xx", "HTTP 200 with a truncated/invalid body")
+
+
+class PIClient:
+    """One keep-alive session per user; WebIds are resolved once and kept on disk"""
+    def __init__(self, auth, pool_size=PI_WORKERS, limiter=None):
+        self.limiter = limiter or PI_LIMITER
+        self.session = requests.Session()
+        self.session.auth, self.session.verify = auth, False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter); self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        try:
+            with open(WEBID_FILE, encoding="utf-8") as f: self._webids = json.load(f)
+        except: self._webids = {}
+
+    def get(self, path, params, timeout, max_retries=3):
+        return self._request("GET", path, timeout, max_retries, params=params)
+
+    def post(self, path, body, timeout, max_retries=3):
+        return self._request("POST", path, timeout, max_retries, json=body)
+
+    def _request(self, method, path, timeout, max_retries, **kw):
+        """Request + JSON through the limiter. Timeouts, 429 and 5xx are retried with jittered
+        backoff while the limiter slot is free for other requests; a Retry-After is waited out
+        in full, or fails the request when over PI_RETRY_AFTER_MAX. Timeouts get a longer
+        timeout on the next try. Other 4xx are raised straight away."""
+        for attempt in range(1, max_retries + 1):
+            try:
+                return self._send(method, path, timeout, **kw)
+            except PIRetryable as e:
+                METRICS.add("retry", e.kind, count=1)
+                if _give_up(attempt, max_retries, e): raise
+                if e.kind == "timeout": timeout *= 1.5
+                time.sleep(_backoff(attempt, e.wait))
+
+    def _send(self, method, path, timeout, **kw):
+        self.limiter.acquire()
+        t0, ok, congested, nbytes = time.time(), False, False, 0
+        try:
+            try:
+                r = self.session.request(method, f"{PI_BASE}{path}", timeout=timeout, **kw)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                raise PIRetryable("timeout", f"PI timeout/connection error: {e}")
+            nbytes = len(r.content)
+            ok = _check_status(r.status_code, r.headers)
+            return _json(r.content)
+        except PIRetryable:
+            congested = True; raise
+        finally:
+            endpoint = path.rsplit("/", 1)[-1]
+            self.limiter.release(endpoint, time.time() - t0 if ok else None, _outcome(ok, congested))
+            METRICS.observe("http", time.time() - t0, endpoint, bytes=nbytes, errors=not ok)
+
+    def webid(self, tag_path, max_retries=3):
+        if tag_path not in self._webids:
+            with METRICS.time("webid", tag_path):
+                self.remember(tag_path, self.get("/points", {"path": _pi_path(tag_path)}, 20, max_retries)["WebId"])
+        return self._webids[tag_path]
+
+    def known_webid(self, tag_path):
+        return self._webids.get(tag_path)
+
+    def remember(self, tag_path, webid):
+        with self._lock:
+            if self._webids.get(tag_path) != webid:
+                self._webids[tag_path] = webid; self._persist()
+
+    def forget(self, tag_path):
+        with self._lock:
+            if self._webids.pop(tag_path, None): self._persist()
+
+    def _persist(self):
+        tmp = f"{WEBID_FILE}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f: json.dump(self._webids, f)
+            os.replace(tmp, WEBID_FILE)
+        except: pass
+
+
+# ============================================================
+# PI FETCH — paged recorded data + cache
+# ============================================================
+_CIVIL = np.array([1000, 100, 10, 1])
+
+def _parse_pi_times(ts):
+    """PI 'YYYY-MM-DDTHH:MM:SS[.fffffff]Z' strings → UTC epoch ns, computed on the raw bytes;
+    anything else goes through pandas' ISO8601 parser"""
+    b = np.array(ts, dtype='S')
+    w = b.dtype.itemsize
+    if not len(b) or w < 20: return pd.to_datetime(ts, format='ISO8601', utc=True).as_unit('ns').asi8
+    u = b.view('uint8').reshape(len(b), w)
+    n = (u != 0).sum(1)   # string lengths (S pads with NUL)
+    end = u[np.arange(len(b)), n - 1]
+    ok = ((u[:, 4] == 45) & (u[:, 7] == 45) & (u[:, 10] == 84) & (u[:, 13] == 58) & (u[:, 16] == 58)
+          & (end == 90) & ((n == 20) | (u[:, 19] == 46)))
+    if not ok.all(): return pd.to_datetime(ts, format='ISO8601', utc=True).as_unit('ns').asi8
+    d = u[:, :19].astype('int64') - 48
+    Y, M, D = d[:, 0:4] @ _CIVIL, d[:, 5] * 10 + d[:, 6], d[:, 8] * 10 + d[:, 9]
+    # days since 1970-01-01 from the civil date (proleptic Gregorian)
+    y = Y - (M <= 2); era = y // 400; yoe = y - era * 400
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + (153 * ((M + 9) % 12) + 2) // 5 + D - 1
+    secs = (era * 146097 + doe - 719468) * 86400 + (d[:, 11] * 10 + d[:, 12]) * 3600 \
+           + (d[:, 14] * 10 + d[:, 15]) * 60 + d[:, 17] * 10 + d[:, 18]
+    ns = secs * 10**9
+    if w > 21:   # fraction digits: columns 20 .. length-2, up to ns resolution
+        f = u[:, 20:min(w, 29)]
+        digit = np.logical_and.accumulate((f >= 48) & (f <= 57), axis=1)
+        ns += (np.where(digit, f.astype('int64') - 48, 0) * 10 ** (8 - np.arange(f.shape[1]))).sum(1)
+    return ns
+
+
+def _decode_items(items):
+    """PI recorded Items → (UTC epoch ns int64, float64 values, uint8 Q bits) without a per-row apply.
+    Digital/system states (Value is a dict) keep their state code and get Q_STATE; text values → NaN"""
+    n = len(items)
+    t = _parse_pi_times([it['Timestamp'] for it in items])
+    vals = [it.get('Value') for it in items]
+    q = (~np.fromiter((it.get('Good', True) for it in items), bool, n)) * np.uint8(Q_BAD)
+    q |= np.fromiter((it.get('Questionable', False) for it in items), bool, n) * np.uint8(Q_QUESTIONABLE)
+    q |= np.fromiter((it.get('Substituted', False) for it in items), bool, n) * np.uint8(Q_SUBSTITUTED)
+    try:
+        v = np.array(vals, dtype='float64')   # all numeric (None → NaN): the common case
+    except (TypeError, ValueError):
+        state = np.fromiter((isinstance(x, dict) for x in vals), bool, n)
+        q |= state * np.uint8(Q_STATE)
+        v = pd.to_numeric(pd.Series([x.get('Value') if s else x for x, s in zip(vals, state)], dtype=object),
+                          errors='coerce').to_numpy('float64')
+    return t, v, q
+
+
+class _ColumnBuffer:
+    """Time/Val/Q columns allocated once and filled page by page"""
+    def __init__(self, capacity):
+        self.t, self.v, self.n = np.empty(capacity, 'int64'), np.empty(capacity, 'float64'), 0
+        self.q = np.empty(capacity, 'uint8')
+
+    def extend(self, t, v, q):
+        end = self.n + len(t)
+        if end > len(self.t):   # estimate was short — grow geometrically
+            cap = max(end, 2 * len(self.t))
+            self.t = np.concatenate([self.t[:self.n], np.empty(cap - self.n, 'int64')])
+            self.v = np.concatenate([self.v[:self.n], np.empty(cap - self.n, 'float64')])
+            self.q = np.concatenate([self.q[:self.n], np.empty(cap - self.n, 'uint8')])
+        self.t[self.n:end], self.v[self.n:end], self.q[self.n:end], self.n = t, v, q, end
+
+    def frame(self):
+        t, v, q = self.t[:self.n], self.v[:self.n], self.q[:self.n]
+        ok = ~np.isnan(v); t, v, q = t[ok], v[ok], q[ok]
+        if not len(t): return pd.DataFrame(columns=['Time', 'Val'])
+        if (np.diff(t) < 0).any():
+            order = np.argsort(t, kind='stable'); t, v, q = t[order], v[order], q[order]
+        return pd.DataFrame({'Time': _local_times(t), 'Val': v.astype('float32'), 'Q': q})
+
+
+class _RecordedPager:
+    """Paging state of one /recorded range: params() → next query (None when done), feed(items)"""
+    def __init__(self, start_str, end_str, tag_path=None):
+        self.tag = tag_path
+        self.t0, self.t1 = pd.Timestamp(start_str).value, pd.Timestamp(end_str).value
+        self.end_str, self.page_start = end_str, start_str
+        self.buf, self.pages, self.last_t, self.done = None, 0, None, False
+
+    def params(self):
+        if self.done: return None
+        return {"startTime": self.page_start, "endTime": self.end_str, "maxCount": PI_PAGE_SIZE}
+
+    def feed(self, items):
+        self.pages += 1
+        if not items: self.done = True; return
+        with METRICS.time("decode", self.tag, points=len(items)):
+            t, v, q = _decode_items(items)
+        if self.last_t is not None:   # the next page starts at the previous last timestamp
+            keep = t > self.last_t; t, v, q = t[keep], v[keep], q[keep]
+        if self.buf is None:
+            # size the buffer from the first page's point density over the whole range
+            span = max(int(t[-1]) - self.t0, 1) if len(items) >= PI_PAGE_SIZE else 0
+            est = int(len(t) * (self.t1 - self.t0) / span * 1.1) if span else len(t)
+            self.buf = _ColumnBuffer(min(est, PI_BUFFER_PAGES * PI_PAGE_SIZE))
+        self.buf.extend(t, v, q)
+        if len(items) < PI_PAGE_SIZE or not len(t): self.done = True; return
+        self.last_t, self.page_start = t[-1], items[-1]['Timestamp']
+
+    def frame(self):
+        df = self.buf.frame() if self.buf is not None else pd.DataFrame(columns=['Time', 'Val'])
+        df.attrs.update(pi_pages=self.pages, pi_points=len(df))
+        return df
+
+
+def _read_recorded(client, webid, start_str, end_str, max_retries=3, tag_path=None):
+    """Paged /recorded for one WebId → Time/Val frame (attrs: pi_pages, pi_points)"""
+    pager = _RecordedPager(start_str, end_str, tag_path)
+    while (params := pager.params()) is not None:
+        pager.feed(client.get(f"/streams/{webid}/recorded", params, 45, max_retries).get("Items", []))
+    return pager.frame()
+
+
+def _fetch_recorded(tag_path, client, start_str, end_str, max_retries=3):
+    """WebId + paged /recorded; returns Time/Val or an _error frame"""
+    t0 = time.perf_counter()
+    try:
+        try:
+            df = _read_recorded(client, client.webid(tag_path, max_retries), start_str, end_str, max_retries, tag_path)
+        except LookupError:   # cached WebId went stale (point rebuilt) — resolve it again once
+            client.forget(tag_path)
+            df = _read_recorded(client, client.webid(tag_path, max_retries), start_str, end_str, max_retries, tag_path)
+    except Exception as e:
+        # 401 → no retry — invalid credentials
+        df = pd.DataFrame({'Time':[None],'Val':[None],'_error':[str(e)],'_tag':[tag_path]})
+    _download_metrics(tag_path, time.perf_counter() - t0, df)
+    return df
+
+
+def _download_metrics(tag_path, seconds, df):
+    METRICS.observe("download", seconds, tag_path, points=df.attrs.get('pi_points', 0),
+                    pages=df.attrs.get('pi_pages', 0), errors='_error' in df.columns)
+
+
+def _split_days(df, days):
+    """Cut a fetched frame into {UTC day: frame}; days without points get an empty frame"""
+    out = {d: pd.DataFrame(columns=['Time', 'Val']) for d in days}
+    if df.empty: return out
+    utc_day = pd.to_datetime(_utc_ns(df['Time'])).date
+    for d, part in df.groupby(utc_day, sort=False):
+        if d in out: out[d] = part.reset_index(drop=True)
+    return out
+
+
+def _pi_time(t):
+    """Local (Bangkok) timestamp → PI UTC time string"""
+    return pd.Timestamp(t).tz_localize('Asia/Bangkok').tz_convert('UTC').strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _append_tail(old, new):
+    if old is None or old.empty: return new
+    if new.empty: return old
+    return (pd.concat([old, new]).drop_duplicates('Time', keep='last')
+            .sort_values('Time', ignore_index=True))
+
+
+def _cache_plan(tag_path, start_time, end_time, incremental):
+    """Cached days for a range plus the runs of stale/missing days still to fetch"""
+    s_day = _as_date(start_time)
+    e_day = _as_date(end_time) if end_time else datetime.now(timezone.utc).date()
+    days  = [s_day + timedelta(days=i) for i in range((e_day - s_day).days + 1)]
+
+    ttl    = CACHE_TAIL_MIN / 60 if incremental else CACHE_TTL_HOURS
+    t0     = time.perf_counter()
+    cached = {d: _load_day(tag_path, d, ttl) for d in days}
+    frames = {d: df for d, (df, fresh) in cached.items() if fresh}
+    METRICS.observe("disk_read", time.perf_counter() - t0, tag_path, hits=len(frames), misses=len(days) - len(frames))
+    runs, run = [], []
+    for d in days:
+        if d not in frames: run.append(d)
+        elif run: runs.append(run); run = []
+    if run: runs.append(run)
+
+    gaps = []
+    for run in runs:
+        # incremental: a stale day only needs the points after its last cached Time
+        head = cached[run[0]][0] if incremental else None
+        start_str = (_pi_time(head['Time'].iloc[-1]) if head is not None and not head.empty
+                     else f"{run[0]:%Y-%m-%d}T00:00:00Z")
+        gaps.append({"days": run, "head": head, "start": start_str,
+                     "end": f"{run[-1] + timedelta(days=1):%Y-%m-%d}T00:00:00Z"})
+    return {"tag": tag_path, "days": days, "frames": frames, "gaps": gaps, "pages": 0, "points": 0}
+
+
+def _cache_fill(plan, gap, df):
+    """Store one fetched gap day by day"""
+    plan["pages"] += df.attrs.get('pi_pages', 0); plan["points"] += df.attrs.get('pi_points', 0)
+    with METRICS.time("disk_write", plan["tag"], days=len(gap["days"])):
+        for d, part in _split_days(df, gap["days"]).items():
+            if d == gap["days"][0]: part = _append_tail(gap["head"], part)
+            plan["frames"][d] = part
+            _save_day(plan["tag"], d, part)
+
+
+def _cache_result(plan):
+    parts = [f for f in (plan["frames"].get(d) for d in plan["days"]) if f is not None and not f.empty]
+    out = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['Time', 'Val'])
+    out.attrs.update(pi_pages=plan["pages"], pi_points=plan["points"])
+    return out
+
+
+# ============================================================
+# SHARED MEMORY CACHE — one copy per tag/range for all sessions
+# ============================================================
+def _shared_view(df):
+    """Same data buffers, but no PI traffic attributed to this reader"""
+    out = df.copy(deep=False); out.attrs = {"pi_pages": 0, "pi_points": 0}
+    return out
+
+
+class SharedFrameCache:
+    """Process-wide LRU of fetched frames (bounded by bytes) with single-flight:
+    identical concurrent requests wait for the one already in flight"""
+    def __init__(self, max_bytes):
+        self.max_bytes, self.bytes = max_bytes, 0
+        self.hits = self.misses = self.waits = 0
+        self._items, self._flight = OrderedDict(), {}   # key → (df, nbytes, expires) / Future
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, ttl=None):
+        state, val = self._claim(key)
+        if state == "hit":  return _shared_view(val)
+        if state == "wait": return _shared_view(val.result())
+        try: df = fetch()
+        except BaseException as e: self._settle(key, val, error=e); raise
+        return self._settle(key, val, df, ttl)
+
+    async def aget(self, key, fetch, ttl=None):
+        """get() for the event loop: `fetch` is a coroutine function, waiting never blocks the loop"""
+        state, val = self._claim(key)
+        if state == "hit":  return _shared_view(val)
+        if state == "wait":   # shielded: a waiter's own timeout must not cancel the owner's fetch
+            return _shared_view(await asyncio.shield(asyncio.wrap_future(val)))
+        try: df = await fetch()
+        except BaseException as e: self._settle(key, val, error=e); raise
+        return self._settle(key, val, df, ttl)
+
+    def _claim(self, key):
+        """("hit", df) / ("wait", Future of the fetch in flight) / ("own", Future this caller must settle)"""
+        with self._lock:
+            hit = self._items.get(key)
+            if hit and (hit[2] is None or hit[2] > time.time()):
+                self._items.move_to_end(key); self.hits += 1
+                METRICS.add("memory", key[0], hits=1)
+                return "hit", hit[0]
+            if key in self._flight:
+                self.waits += 1; METRICS.add("memory", key[0], waits=1)
+                return "wait", self._flight[key]
+            self.misses += 1; METRICS.add("memory", key[0], misses=1)
+            fut = self._flight[key] = concurrent.futures.Future()
+            return "own", fut
+
+    def _settle(self, key, fut, df=None, ttl=None, error=None):
+        with self._lock:
+            self._flight.pop(key, None)
+            if error is None and '_error' not in df.columns: self._put(key, df, ttl)
+        if fut.cancelled(): return df
+        if error is None: fut.set_result(df)
+        elif isinstance(error, Exception): fut.set_exception(error)
+        else:   # owner cancelled / interrupted — waiters get an error they can report per tag
+            fut.set_exception(RuntimeError(f"{key[0]}: fetch cancelled ({type(error).__name__})"))
+        return df
+
+    def peek(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit and (hit[2] is None or hit[2] > time.time()):
+                self._items.move_to_end(key); return _shared_view(hit[0])
+
+    def put(self, key, df, ttl=None):
+        with self._lock: self._put(key, df, ttl)
+
+    def _put(self, key, df, ttl):
+        nbytes = int(df.memory_usage(index=True).sum())
+        if nbytes > self.max_bytes: return
+        old = self._items.pop(key, None)
+        if old: self.bytes -= old[1]
+        while self._items and self.bytes + nbytes > self.max_bytes:
+            self.bytes -= self._items.popitem(last=False)[1][1]
+        self._items[key] = (df, nbytes, time.time() + ttl if ttl else None)
+        self.bytes += nbytes
+
+    def clear(self, tags=None):
+        with self._lock:
+            for key in [k for k in self._items if tags is None or k[0] in tags]:
+                self.bytes -= self._items.pop(key)[1]
+
+
+SHARED_FRAMES = SharedFrameCache(SHARED_CACHE_MB * 2**20)
+
+
+def _shared_key(tag_path, start_time, end_time, incremental):
+    """Key + TTL: a range that reaches today goes stale like today's day file; older ranges never do"""
+    e_day = _as_date(end_time) if end_time else None
+    live  = e_day is None or e_day >= datetime.now(timezone.utc).date()
+    ttl   = (CACHE_TAIL_MIN * 60 if incremental else CACHE_TTL_HOURS * 3600) if live else None
+    return (tag_path, _as_date(start_time), e_day, incremental), ttl
+
+
+def get_data_pi(tag_path, client, start_time, end_time=None, max_retries=3, incremental=True):
+    if not tag_path:
+        return pd.DataFrame(columns=['Time', 'Val'])
+    if isinstance(client, AsyncPIClient):
+        return client.submit(aget_data_pi(tag_path, client, start_time, end_time, max_retries, incremental)).result()
+    key, ttl = _shared_key(tag_path, start_time, end_time, incremental)
+    return SHARED_FRAMES.get(key, lambda: _get_data_pi(tag_path, client, start_time, end_time,
+                                                       max_retries, incremental), ttl)
+
+
+def _get_data_pi(tag_path, client, start_time, end_time, max_retries, incremental):
+    # check cache, then fetch each run of stale/missing days as one contiguous PI call
+    plan = _cache_plan(tag_path, start_time, end_time, incremental)
+    for gap in plan["gaps"]:
+        df = _fetch_recorded(tag_path, client, gap["start"], gap["end"], max_retries)
+        if '_error' in df.columns: return df
+        _cache_fill(plan, gap, df)
+    return _cache_result(plan)
+
+
+def pi_traffic(*dfs):
+    """(pages, points) actually downloaded for a set of get_data_pi results"""
+    return (sum(d.attrs.get('pi_pages', 0) for d in dfs),
+            sum(d.attrs.get('pi_points', 0) for d in dfs))
+
+
+def _submit_fetch(ex, tag_path, client, start_time, end_time=None):
+    """Future of get_data_pi: a task on the event loop for an AsyncPIClient, a pool thread otherwise"""
+    if isinstance(client, AsyncPIClient):
+        return client.submit(aget_data_pi(tag_path, client, start_time, end_time))
+    return ex.submit(get_data_pi, tag_path, client, start_time, end_time)
+
+
+def fetch_all_tags_parallel(tag_dict, client, start_time, end_time=None, max_workers=PI_WORKERS):
+    """Fetch all tanks in parallel"""
+    results, errors = {}, {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = {_submit_fetch(ex, tag, client, start_time, end_time): name for name, tag in tag_dict.items()}
+        for fut in concurrent.futures.as_completed(futs):
+            name = futs[fut]
+            try:
+                df = fut.result()
+                if '_error' in df.columns and not df.empty:
+                    errors[name] = df['_error'].iloc[0]
+                    results[name] = pd.DataFrame(columns=['Time', 'Val'])
+                else:
+                    results[name] = df
+            except Exception as e:
+                errors[name] = str(e)
+                results[name] = pd.DataFrame(columns=['Time', 'Val'])
+    return results, errors
+
+
+# ============================================================
+# PI ASYNC — every fetch as a task on one background event loop
+# ============================================================
+PI_TAG_TIMEOUT    = 600   # s; a tag fetch still running after this is cancelled
+
+
+_loop, _loop_lock = None, threading.Lock()
+
+def pi_event_loop():
+    """Event loop on a daemon thread, started on first use and shared by the whole process"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="cip-pi-loop", daemon=True).start()
+        return _loop
+
+
+class AsyncPIClient(PIClient):
+    """PIClient whose fetches run on the event loop (tornado's asyncio HTTP client):
+    in-flight requests are bounded by the process-wide PI_LIMITER, not by a thread count.
+    Tornado's simple client opens a new connection (TCP + TLS handshake) per request —
+    no keep-alive, unlike the pooled requests.Session of the thread engine."""
+    def __init__(self, auth, loop):
+        super().__init__(auth)
+        self.loop, self._http = loop, None
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop → concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def aget(self, path, params, timeout, max_retries=3):
+        url = f"{PI_BASE}{path}?{urlencode(params)}"
+        for attempt in range(1, max_retries + 1):
+            try:
+                return await self._asend(url, path, timeout)
+            except PIRetryable as e:
+                METRICS.add("retry", e.kind, count=1)
+                if _give_up(attempt, max_retries, e): raise
+                if e.kind == "timeout": timeout *= 1.5
+                await asyncio.sleep(_backoff(attempt, e.wait))
+
+    async def _asend(self, url, path, timeout):
+        if self._http is None:   # bound to the loop — create on first use, from the loop thread
+            self._http = AsyncHTTPClient(force_instance=True, max_clients=PI_ASYNC_INFLIGHT)
+        await self.limiter.acquire_async()
+        t0, ok, congested, nbytes = time.time(), False, False, 0
+        try:
+            r = await self._http.fetch(HTTPRequest(
+                url, auth_username=self.session.auth.username, auth_password=self.session.auth.password,
+                validate_cert=False, connect_timeout=timeout, request_timeout=timeout), raise_error=False)
+            if r.code == 599:   # tornado: timeout / connection error
+                raise PIRetryable("timeout", f"PI timeout/connection error: {r.error}")
+            nbytes = len(r.body or b"")
+            ok = _check_status(r.code, r.headers)
+            return await asyncio.to_thread(_json, r.body) if nbytes > 2**16 else _json(r.body)
+        except PIRetryable:
+            congested = True; raise
+        finally:
+            endpoint = path.rsplit("/", 1)[-1]
+            self.limiter.release(endpoint, time.time() - t0 if ok else None, _outcome(ok, congested))
+            METRICS.observe("http", time.time() - t0, endpoint, bytes=nbytes, errors=not ok)
+
+    async def awebid(self, tag_path, max_retries=3):
+        if tag_path not in self._webids:
+            t0 = time.perf_counter()
+            self.remember(tag_path, (await self.aget("/points", {"path": _pi_path(tag_path)}, 20, max_retries))["WebId"])
+            METRICS.observe("webid", time.perf_counter() - t0, tag_path)
+        return self._webids[tag_path]
+
+
+async def _aread_recorded(client, webid, start_str, end_str, max_retries=3, tag_path=None):
+    """_read_recorded on the event loop; pages are decoded on a worker thread"""
+    pager = _RecordedPager(start_str, end_str, tag_path)
+    while (params := pager.params()) is not None:
+        items = (await client.aget(f"/streams/{webid}/recorded", params, 45, max_retries)).get("Items", [])
+        await asyncio.to_thread(pager.feed, items)
+    return pager.frame()
+
+
+async def _afetch_recorded(tag_path, client, start_str, end_str, max_retries=3):
+    """_fetch_recorded on the event loop"""
+    t0 = time.perf_counter()
+    try:
+        try:
+            df = await _aread_recorded(client, await client.awebid(tag_path, max_retries),
+                                       start_str, end_str, max_retries, tag_path)
+        except LookupError:
+            client.forget(tag_path)
+            df = await _aread_recorded(client, await client.awebid(tag_path, max_retries),
+                                       start_str, end_str, max_retries, tag_path)
+    except Exception as e:
+        df = pd.DataFrame({'Time':[None],'Val':[None],'_error':[str(e)],'_tag':[tag_path]})
+    _download_metrics(tag_path, time.perf_counter() - t0, df)
+    return df
+
+
+async def _aget_data_pi(tag_path, client, start_time, end_time, max_retries, incremental):
+    # same cache plan as _get_data_pi, but the gaps are fetched concurrently;
+    # day-file reads/writes run on worker threads so the loop keeps serving other requests
+    plan = await asyncio.to_thread(_cache_plan, tag_path, start_time, end_time, incremental)
+    dfs  = await asyncio.gather(*(_afetch_recorded(tag_path, client, g["start"], g["end"], max_retries)
+                                  for g in plan["gaps"]))
+    for gap, df in zip(plan["gaps"], dfs):
+        if '_error' in df.columns: return df
+        await asyncio.to_thread(_cache_fill, plan, gap, df)
+    return await asyncio.to_thread(_cache_result, plan)
+
+
+async def aget_data_pi(tag_path, client, start_time, end_time=None, max_retries=3, incremental=True):
+    """get_data_pi as a coroutine for AsyncPIClient; cancelled after PI_TAG_TIMEOUT"""
+    key, ttl = _shared_key(tag_path, start_time, end_time, incremental)
+    try:
+        return await asyncio.wait_for(SHARED_FRAMES.aget(key, lambda: _aget_data_pi(
+            tag_path, client, start_time, end_time, max_retries, incremental), ttl), PI_TAG_TIMEOUT)
+    except asyncio.TimeoutError:
+        return pd.DataFrame({'Time':[None],'Val':[None],'_error':[f"Timeout after {PI_TAG_TIMEOUT}s"],'_tag':[tag_path]})
+
+
+# ============================================================
+# PI BATCH — all WebId lookups + recorded reads in a few /batch calls
+# ============================================================
+def _batch_content(resp):
+    """Content of a successful /batch sub-response, unwrapping the per-parameter Items wrapper"""
+    if not resp or resp.get("Status") not in (200, 207): return None
+    c = resp.get("Content") or {}
+    items = c.get("Items")
+    if items and isinstance(items[0], dict) and "Status" in items[0] and "Content" in items[0]:
+        return _batch_content(items[0])
+    return c
+
+
+def _batch_recorded(client, tag_path, resp, gap, max_retries):
+    """Frame for one gap from its /batch sub-response; anything unusual is re-read the normal way"""
+    content = _batch_content(resp)
+    if content is None:
+        if resp and resp.get("Status") == 404: client.forget(tag_path)
+        return _fetch_recorded(tag_path, client, gap["start"], gap["end"], max_retries)
+    items = content.get("Items", [])
+    if not items:
+        df = pd.DataFrame(columns=['Time', 'Val'])
+    else:
+        with METRICS.time("decode", tag_path, points=len(items)):
+            buf = _ColumnBuffer(len(items)); buf.extend(*_decode_items(items)); df = buf.frame()
+    pages = 1
+    if len(items) >= PI_PAGE_SIZE:   # first page was full — page the rest directly
+        rest = _fetch_recorded(tag_path, client, items[-1]["Timestamp"], gap["end"], max_retries)
+        if '_error' in rest.columns: return rest
+        last = pd.Timestamp(items[-1]["Timestamp"]).tz_convert('Asia/Bangkok').tz_localize(None)
+        pages += rest.attrs.get('pi_pages', 0)
+        df = pd.concat([df, rest[rest['Time'] > last]], ignore_index=True)
+    df.attrs.update(pi_pages=pages, pi_points=len(df))
+    return df
+
+
+def fetch_batch(tag_dict, client, start_time, end_time=None, max_retries=3, incremental=True):
+    """Same result as fetch_all_tags_parallel, but the PI traffic goes out as /batch calls"""
+    shared = {}
+    for tag in dict.fromkeys(tag_dict.values()):
+        if tag: shared[tag] = SHARED_FRAMES.peek(_shared_key(tag, start_time, end_time, incremental)[0])
+    plans = {tag: _cache_plan(tag, start_time, end_time, incremental)
+             for tag, hit in shared.items() if hit is None}
+
+    # one group of sub-requests per tag: WebId lookup (if unknown) + one recorded read per gap
+    groups = []
+    for i, (tag, plan) in enumerate(plans.items()):
+        if not plan["gaps"]: continue
+        reqs, webid = {}, client.known_webid(tag)
+        if webid is None:
+            reqs[f"w{i}"] = {"Method": "GET",
+                             "Resource": f"{PI_BASE}/points?{urlencode({'path': _pi_path(tag)})}"}
+        for j, gap in enumerate(plan["gaps"]):
+            q = urlencode({"startTime": gap["start"], "endTime": gap["end"], "maxCount": PI_PAGE_SIZE})
+            reqs[f"r{i}_{j}"] = ({"Method": "GET", "Resource": f"{PI_BASE}/streams/{webid}/recorded?{q}"}
+                                 if webid else
+                                 {"Method": "GET", "Resource": f"{PI_BASE}/streams/{{0}}/recorded?{q}",
+                                  "ParentIds": [f"w{i}"], "Parameters": [f"$.w{i}.Content.WebId"]})
+        groups.append(reqs)
+
+    chunks, cur = [], {}
+    for reqs in groups:   # a tag's lookup and its reads always share a call
+        if cur and len(cur) + len(reqs) > PI_BATCH_SIZE: chunks.append(cur); cur = {}
+        cur.update(reqs)
+    if cur: chunks.append(cur)
+
+    responses, fatal = {}, None
+    for chunk in chunks:
+        try:
+            responses.update(client.post("/batch", chunk, 120, max_retries))
+        except PermissionError as e:
+            fatal = str(e); break
+        except Exception:
+            pass   # missing sub-responses fall back to per-tag reads below
+
+    frames, tag_errors = {}, {}
+    for i, (tag, plan) in enumerate(plans.items()):
+        if fatal: tag_errors[tag] = fatal; continue
+        w = _batch_content(responses.get(f"w{i}"))
+        if w and w.get("WebId"): client.remember(tag, w["WebId"])
+        for j, gap in enumerate(plan["gaps"]):
+            df = _batch_recorded(client, tag, responses.get(f"r{i}_{j}"), gap, max_retries)
+            if '_error' in df.columns:
+                tag_errors[tag] = df['_error'].iloc[0]; break
+            _cache_fill(plan, gap, df)
+        else:
+            frames[tag] = _cache_result(plan)
+            key, ttl = _shared_key(tag, start_time, end_time, incremental)
+            SHARED_FRAMES.put(key, frames[tag], ttl)
+    frames.update({tag: hit for tag, hit in shared.items() if hit is not None})
+
+    results, errors = {}, {}
+    for name, tag in tag_dict.items():
+        if tag in tag_errors:
+            errors[name] = tag_errors[tag]; results[name] = pd.DataFrame(columns=['Time', 'Val'])
+        else:
+            results[name] = frames.get(tag, pd.DataFrame(columns=['Time', 'Val']))
+    return results, errors
+
+
+# ============================================================
+# PLOT DATA — ±window by binary search, reduced to a pixel budget
+# ============================================================
+PLOT_POINTS = 2000   # points per series sent to the browser
+
+
+def time_slice(df, start, end):
+    """Rows of a Time-sorted frame within [start, end]"""
+    if df.empty: return df
+    t = df['Time'].to_numpy('datetime64[ns]')
+    i0 = np.searchsorted(t, pd.Timestamp(start).to_datetime64(), 'left')
+    i1 = np.searchsorted(t, pd.Timestamp(end).to_datetime64(), 'right')
+    return df.iloc[i0:i1]
+
+
+def downsample(df, n=PLOT_POINTS):
+    """Keep the min and max point of each of n/2 equal-count buckets (plus both ends),
+    so short temperature peaks survive however long the window is"""
+    if len(df) <= n: return df
+    y  = df['Val'].to_numpy('float64')
+    b  = np.arange(len(y)) * (n // 2) // len(y)            # bucket per row, non-decreasing
+    order  = np.lexsort((y, b))                             # by bucket, then by value
+    starts = np.flatnonzero(np.diff(b, prepend=-1))
+    ends   = np.r_[starts[1:], len(y)] - 1
+    keep   = np.unique(np.r_[0, len(y) - 1, order[starts], order[ends]])
+    return df.iloc[keep]
+
+
+def fetch_plot(client, tag_path, start, end, intervals=PLOT_POINTS // 2):
+    """PI /plot (server-side min/max per interval) for a window that is not cached locally"""
+    try:
+        items = client.get(f"/streams/{client.webid(tag_path)}/plot",
+                           {"startTime": _pi_time(start), "endTime": _pi_time(end), "intervals": intervals},
+                           45).get("Items", [])
+        if not items: return pd.DataFrame(columns=['Time', 'Val'])
+        buf = _ColumnBuffer(len(items)); buf.extend(*_decode_items(items))
+        return buf.frame()
+    except Exception:
+        return pd.DataFrame(columns=['Time', 'Val'])
+
+
+# ============================================================
+# PIPELINE — fetch + analyse every tank on one shared pool
+# ============================================================
+def analyse_plant(factories, client, start_time, end_time=None, max_workers=PI_WORKERS, analysis_workers=1):
+    """Fetch all temp + chemical tags of `factories` on one bounded pool and index each tank
+    as soon as its temp frame and its factory's chemical frame are both in
+    (on the process pool when analysis_workers > 1 and the tank is big enough).
+
+    Yields (done, total, kind, factory, tank, payload) per finished task, kind being
+    "conc" / "temp" (payload = frame), "error" (payload = message of a failed fetch or analysis) or
+    "index" (payload = (temp_df, conc_df, cycle index)). A tank whose process-pool worker died
+    is indexed again in-process.
+    """
+    empty = pd.DataFrame(columns=['Time', 'Val'])
+    conc, waiting, futs, inputs = {}, {}, {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+        def _analyse(f_name, tank, df_temp, workers=analysis_workers):
+            fut = submit_cycle_index(df_temp, conc[f_name], ex, workers)
+            futs[fut], inputs[fut] = ("index", f_name, tank), (df_temp, conc[f_name])
+            t0, tag = time.perf_counter(), factories[f_name]["tags"][tank]
+            fut.add_done_callback(lambda _, t0=t0, tag=tag, n=len(df_temp):
+                                  METRICS.observe("analysis", time.perf_counter() - t0, tag, points=n))
+
+        for f_name, f_conf in factories.items():
+            if f_conf["cip_tag"]:
+                futs[_submit_fetch(ex, f_conf["cip_tag"], client, start_time, end_time)] = ("conc", f_name, None)
+            else:
+                conc[f_name] = empty
+            for tank, tag in f_conf["tags"].items():
+                futs[_submit_fetch(ex, tag, client, start_time, end_time)] = ("temp", f_name, tank)
+
+        done, total = 0, len(futs) + sum(len(c["tags"]) for c in factories.values())
+        while futs:
+            finished, _ = concurrent.futures.wait(futs, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                kind, f_name, tank = futs.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    if kind == "index" and isinstance(e, BrokenProcessPool):
+                        # a pool worker died (OOM / killed) — index this tank again in-process
+                        _analyse(f_name, tank, inputs.pop(fut)[0], workers=1); continue
+                    if kind == "index":
+                        inputs.pop(fut); done += 1
+                        yield done, total, "error", f_name, tank, f"Analysis failed: {e}"; continue
+                    res = pd.DataFrame({'Time':[None],'Val':[None],'_error':[str(e)],'_tag':[None]})
+                done += 1
+                if kind == "index":
+                    yield done, total, kind, f_name, tank, (*inputs.pop(fut), res); continue
+                if '_error' in res.columns and not res.empty:
+                    yield done, total, "error", f_name, tank, res['_error'].iloc[0]
+                    res = empty
+                else:
+                    yield done, total, kind, f_name, tank, res
+                if kind == "conc":
+                    conc[f_name] = res
+                    for t_name, df_temp in waiting.pop(f_name, {}).items(): _analyse(f_name, t_name, df_temp)
+                elif res.empty:
+                    total -= 1   # nothing to analyse for this tank
+                elif f_name in conc:
+                    _analyse(f_name, tank, res)
+                else:
+                    waiting.setdefault(f_name, {})[tank] = res
+
+
+
+# ============================================================
+# PRECOMPUTED — cycle indexes per date range, written by cip_precompute.py
+# ============================================================
+PRECOMPUTED_DIR = os.path.join(CACHE_DIR, "precomputed")
+
+
+def _precomputed_path(start_time, end_time):
+    return os.path.join(PRECOMPUTED_DIR, f"{_as_date(start_time):%Y-%m-%d}_{_as_date(end_time):%Y-%m-%d}.pickle")
+
+
+def save_precomputed(start_time, end_time, index, errors, factories):
+    """Store {(factory, tank): cycle index} of `factories` for one date range (atomic replace)"""
+    os.makedirs(PRECOMPUTED_DIR, exist_ok=True)
+    return _store_precomputed(_precomputed_path(start_time, end_time),
+                              {"created": time.time(), "factories": list(factories), "index": index,
+                               "errors": errors})
+
+
+def _store_precomputed(fpath, pre):
+    tmp = f"{fpath}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f: pickle.dump(pre, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fpath)
+    return fpath
+
+
+def drop_precomputed(tags=None):
+    """Take every factory using one of `tags` (all when None) out of the stored results, so the
+    next run analyses it from PI again instead of reusing cycles of cleared data.
+    Returns the number of result files changed or removed."""
+    hit = None if tags is None else {f for f, c in FACTORY_CONFIG.items()
+                                     if set(tags) & {*c["tags"].values(), c["cip_tag"]}}
+    try: names = [n for n in os.listdir(PRECOMPUTED_DIR) if n.endswith(".pickle")]
+    except OSError: return 0
+    n = 0
+    for name in names:
+        fpath = os.path.join(PRECOMPUTED_DIR, name)
+        try:
+            with open(fpath, "rb") as f: pre = pickle.load(f)
+        except: continue
+        keep = [] if hit is None else [f for f in pre["factories"] if f not in hit]
+        if len(keep) == len(pre["factories"]): continue
+        n += 1
+        if not keep:
+            try: os.remove(fpath)
+            except OSError: pass
+            continue
+        pre.update(factories=keep, index={k: v for k, v in pre["index"].items() if k[0] in keep},
+                   errors={k: e for k, e in pre["errors"].items() if k.split("/")[0] in keep})
+        _store_precomputed(fpath, pre)
+    return n
+
+
+def load_precomputed(start_time, end_time, max_age_hours=CACHE_TTL_HOURS):
+    """Stored result for exactly this date range, or None; a range reaching today expires after max_age_hours"""
+    fpath = _precomputed_path(start_time, end_time)
+    try:
+        with open(fpath, "rb") as f: pre = pickle.load(f)
+    except: return None
+    live = _as_date(end_time) >= datetime.now(timezone.utc).date()
+    if live and time.time() - pre["created"] > max_age_hours * 3600: return None
+    return pre
+
+
+# ============================================================
+# LIVE — only the points recorded since the previous poll
+# ============================================================
+LIVE_POLL_SEC   = 30   # dashboard live-mode refresh interval
+LIVE_LOOKBACK_H = 12   # history read on the first poll (covers a cycle that is already running)
+
+
+def _now_local():
+    return pd.Timestamp.now(tz='Asia/Bangkok').tz_localize(None)
+
+
+class LiveFeed:
+    """High-water mark per tag: poll() reads /recorded from the last point seen up to now,
+    so a poll costs the new points only — no day files, no re-read of the history"""
+    def __init__(self, client, tag_dict, lookback_hours=LIVE_LOOKBACK_H):
+        self.client   = client
+        self.tag_dict = {k: t for k, t in tag_dict.items() if t}
+        self.since    = dict.fromkeys(self.tag_dict, _now_local() - pd.Timedelta(hours=lookback_hours))
+        self.polled   = None
+
+    def _submit(self, ex, tag, start, end):
+        if isinstance(self.client, AsyncPIClient):
+            return self.client.submit(_afetch_recorded(tag, self.client, _pi_time(start), _pi_time(end)))
+        return ex.submit(_fetch_recorded, tag, self.client, _pi_time(start), _pi_time(end))
+
+    def poll(self, max_workers=PI_WORKERS):
+        """({key: Time/Val frame of new points}, {key: error}) since the previous poll"""
+        t0, now = time.perf_counter(), _now_local()
+        frames, errors = {}, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(self.tag_dict) or 1)) as ex:
+            futs = {k: self._submit(ex, tag, self.since[k], now) for k, tag in self.tag_dict.items()}
+            for k, fut in futs.items():
+                try:
+                    df = fut.result()
+                except Exception as e:
+                    df = pd.DataFrame({'Time':[None],'Val':[None],'_error':[str(e)],'_tag':[self.tag_dict[k]]})
+                if '_error' in df.columns:
+                    errors[k] = df['_error'].iloc[0]; frames[k] = pd.DataFrame(columns=['Time', 'Val'])
+                    continue
+                if not df.empty:
+                    df = df[df['Time'] > self.since[k]]   # PI startTime is inclusive
+                    if not df.empty: self.since[k] = df['Time'].iloc[-1]
+                frames[k] = df
+        self.polled = now
+        METRICS.observe("live_poll", time.perf_counter() - t0, None,
+                        points=sum(len(df) for df in frames.values()), errors=len(errors))
+        return frames, errors
+
@@ -0,0 +1,127 @@
+"""
+CIP metrics — per-stage timers and counters for fetch, cache and analysis
+=========================================================================
+- METRICS.time(stage, tag) / observe() / add(): near-free no-ops when CIP_METRICS=0
+- snapshot(mark): rows per (stage, tag) with p50/p95/max latency, for the dashboard panel
+- prometheus() text (serve_prometheus(port) or a textfile-collector file) and write_jsonl()
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+
+_NULL = contextlib.nullcontext()
+
+
+class Metrics:
+    """Process-wide counters + the last `keep` latency samples per (stage, tag)"""
+    def __init__(self, enabled=True, keep=2048):
+        self.enabled, self.keep = enabled, keep
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(float))   # (stage, tag) → {name: total}
+        self._samples  = defaultdict(lambda: deque(maxlen=keep))   # (stage, tag) → (t_end, seconds)
+
+    def observe(self, stage, seconds, tag=None, **counters):
+        if not self.enabled: return
+        with self._lock:
+            c = self._counters[(stage, tag)]
+            c["calls"] += 1; c["seconds"] += seconds
+            for k, v in counters.items(): c[k] += v
+            self._samples[(stage, tag)].append((time.time(), seconds))
+
+    def add(self, stage, tag=None, **counters):
+        if not self.enabled: return
+        with self._lock:
+            c = self._counters[(stage, tag)]
+            for k, v in counters.items(): c[k] += v
+
+    def time(self, stage, tag=None, **counters):
+        """Context manager timing one call of `stage`"""
+        return _Timer(self, stage, tag, counters) if self.enabled else _NULL
+
+    def mark(self):
+        """Baseline for snapshot(): only what happens after this is reported"""
+        with self._lock:
+            return time.time(), {k: dict(c) for k, c in self._counters.items()}
+
+    def snapshot(self, mark=None):
+        """[{stage, tag, calls, seconds, p50_ms, p95_ms, max_ms, <counters>…}] sorted by stage time"""
+        since, base = mark or (0.0, {})
+        rows = []
+        with self._lock:
+            for key, c in self._counters.items():
+                b = base.get(key, {})
+                row = {k: v - b.get(k, 0.0) for k, v in c.items()}
+                if not any(row.values()): continue
+                lat = np.array([s for t, s in self._samples.get(key, ()) if t >= since])
+                if len(lat):
+                    p50, p95 = np.percentile(lat, [50, 95])
+                    row.update(p50_ms=p50 * 1e3, p95_ms=p95 * 1e3, max_ms=lat.max() * 1e3)
+                rows.append({"stage": key[0], "tag": key[1], **row})
+        return sorted(rows, key=lambda r: (-r.get("seconds", 0.0), r["stage"], str(r["tag"])))
+
+    def prometheus(self):
+        """Prometheus text exposition: cip_<stage>_<counter>_total + latency quantiles"""
+        out = []
+        for r in self.snapshot():
+            label = f'{{tag="{r["tag"]}"}}' if r["tag"] is not None else ""
+            for k, v in r.items():
+                if k in ("stage", "tag") or k.endswith("_ms"): continue
+                out.append(f"cip_{r['stage']}_{k}_total{label} {v:.12g}")
+            for q, k in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+                if k in r:
+                    ql = label[:-1] + f',quantile="{q}"}}' if label else f'{{quantile="{q}"}}'
+                    out.append(f"cip_{r['stage']}_latency_seconds{ql} {r[k] / 1e3:g}")
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path):
+        """Atomic textfile for node_exporter's textfile collector"""
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def write_jsonl(self, path, mark=None, **meta):
+        """Append one JSON line per (stage, tag) row"""
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(path, "a", encoding="utf-8") as f:
+            for r in self.snapshot(mark):
+                f.write(json.dumps({"ts": ts, **meta, **r}) + "\n")
+
+
+class _Timer:
+    __slots__ = ("m", "stage", "tag", "counters", "t0")
+
+    def __init__(self, m, stage, tag, counters):
+        self.m, self.stage, self.tag, self.counters = m, stage, tag, counters
+
+    def __enter__(self):
+        self.t0 = time.perf_counter(); return self
+
+    def __exit__(self, *exc):
+        self.m.observe(self.stage, time.perf_counter() - self.t0, self.tag, **self.counters)
+
+
+METRICS = Metrics(enabled=os.environ.get("CIP_METRICS", "1") != "0")
+
+
+def serve_prometheus(port, metrics=METRICS):
+    """GET /metrics on a daemon thread (for a Prometheus scrape of the dashboard server)"""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *a): pass
+        def do_GET(self):
+            body = metrics.prometheus().encode()
+            self.send_response(200 if self.path.rstrip("/") in ("", "/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers(); self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", int(port)), Handler)
+    threading.Thread(target=server.serve_forever, name="cip-metrics", daemon=True).start()
+    return server
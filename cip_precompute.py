@@ -0,0 +1,92 @@
+"""
+CIP precompute — headless fetch + cycle indexing for cron / systemd timers
+=========================================================================
+Pulls every factory/tank (warming the day cache) and stores the cycle indexes of each
+rolling window ending today, so EXECUTE in the dashboard loads them instantly.
+
+    CIP_PI_USER=... CIP_PI_PASSWORD=... python cip_precompute.py --days 7 30 --since 2026-01-01
+
+cron (every 30 min):
+    */30 * * * *  cd /opt/cip && CIP_PI_USER=... CIP_PI_PASSWORD=... python cip_precompute.py
+Exit code 1 when any tag failed, 2 when credentials are missing.
+--metrics-jsonl / --metrics-prom write per-stage timings (fetch, decode, cache, analysis)
+as JSON lines or a Prometheus textfile-collector file.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+from requests.auth import HTTPBasicAuth
+from cip_analysis import ANALYSIS_WORKERS
+from cip_data import (FACTORY_CONFIG, PIClient, AsyncPIClient, pi_event_loop, analyse_plant,
+                      pi_traffic, save_precomputed, init_cache)
+from cip_metrics import METRICS
+
+log = logging.getLogger("cip_precompute")
+
+
+def precompute(client, start, end, factories=FACTORY_CONFIG, analysis_workers=1):
+    """Fetch + index every tank of `factories` for start..end and store the result; returns the errors"""
+    t0, index, errors = time.time(), {}, {}
+    for done, total, kind, f_name, tank, payload in analyse_plant(factories, client, start, end,
+                                                                  analysis_workers=analysis_workers):
+        name = f"{f_name}/{tank or '%CIP'}"
+        if kind == "error":
+            errors[name] = payload
+            log.warning("%s: %s", name, payload)
+        elif kind == "index":
+            if payload[2]: index[(f_name, tank)] = payload[2]
+            log.info("%s: %d cycle(s) [%d/%d, %.1fs]", name, len(payload[2]), done, total, time.time() - t0)
+        else:
+            pages, points = pi_traffic(payload)
+            log.info("%s: %d pts, %d downloaded in %d page(s) [%d/%d, %.1fs]",
+                     name, len(payload), points, pages, done, total, time.time() - t0)
+    path = save_precomputed(start, end, index, errors, factories)
+    log.info("%s → %s: %d tank(s), %d error(s) in %.1fs → %s",
+             start, end, len(index), len(errors), time.time() - t0, path)
+    return errors
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--days", type=int, nargs="*", default=[7, 30],
+                    help="rolling windows: today-N .. today (default 7 30)")
+    ap.add_argument("--since", action="append", default=[],
+                    help="extra window YYYY-MM-DD .. today (repeatable)")
+    ap.add_argument("--factory", action="append", choices=list(FACTORY_CONFIG),
+                    help="only these factories (default: all)")
+    ap.add_argument("--async", dest="use_async", action="store_true", help="async fetch engine")
+    ap.add_argument("--processes", action="store_true",
+                    help=f"index large tanks on {ANALYSIS_WORKERS} worker processes")
+    ap.add_argument("--metrics-jsonl", metavar="PATH", help="append per-stage/tag timings as JSON lines")
+    ap.add_argument("--metrics-prom", metavar="PATH", help="write Prometheus text metrics (textfile collector)")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    user, pw = os.environ.get("CIP_PI_USER"), os.environ.get("CIP_PI_PASSWORD")
+    if not user or not pw:
+        log.error("CIP_PI_USER / CIP_PI_PASSWORD are not set"); return 2
+
+    init_cache()
+    auth    = HTTPBasicAuth(user, pw)
+    client  = AsyncPIClient(auth, pi_event_loop()) if args.use_async else PIClient(auth)
+    factories = {f: FACTORY_CONFIG[f] for f in args.factory} if args.factory else FACTORY_CONFIG
+    today   = date.today()
+    windows = [(today - timedelta(days=n), today) for n in args.days]
+    windows += [(datetime.strptime(s, "%Y-%m-%d").date(), today) for s in args.since]
+
+    failed = False
+    for start, end in windows:
+        mark = METRICS.mark()
+        failed |= bool(precompute(client, start, end, factories, ANALYSIS_WORKERS if args.processes else 1))
+        if args.metrics_jsonl:
+            METRICS.write_jsonl(args.metrics_jsonl, mark, job="precompute", start=str(start), end=str(end))
+    if args.metrics_prom: METRICS.write_prometheus(args.metrics_prom)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
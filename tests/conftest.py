@@ -0,0 +1,40 @@
+"""
+Shared test setup — every test runs on a scratch cache directory
+================================================================
+cip_bench points CIP_CACHE_DIR at a temp dir before cip_data is imported, so the tracked
+fixtures and a real .cip_cache are never read or written by a test run.
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cip_bench   # noqa: E402  (must come before any cip_data import)
+import cip_data    # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_pi():
+    """FakePI on a local port, with cip_data.PI_BASE pointed at it"""
+    fake = cip_bench.FakePI(latency=0.0).start()
+    base, cip_data.PI_BASE = cip_data.PI_BASE, fake.url
+    yield fake
+    cip_data.PI_BASE = base
+    fake.stop()
+
+
+@pytest.fixture
+def clean_cache():
+    """Empty disk + memory cache and no known WebIds"""
+    cip_data.DISK_INDEX.remove(None)
+    cip_data.SHARED_FRAMES.clear()
+    try: os.remove(cip_data.WEBID_FILE)
+    except OSError: pass
+    yield
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(cip_bench.BENCH_CACHE, ignore_errors=True)
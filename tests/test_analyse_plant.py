@@ -0,0 +1,52 @@
+"""
+analyse_plant event stream against FakePI — a failed analysis is reported, not swallowed
+=======================================================================================
+"""
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+
+from requests.auth import HTTPBasicAuth
+
+import cip_data
+from cip_data import FACTORY_CONFIG, PIClient, analyse_plant
+
+FACTORIES = {"DC": FACTORY_CONFIG["DC"]}
+START, END = date(2025, 12, 30), date(2025, 12, 31)
+
+
+def _failing_submit(exc, tanks, real=cip_data.submit_cycle_index):
+    """submit_cycle_index whose future fails with `exc` for the tanks' temp frames (first call only)"""
+    failed = set()
+    def submit(temp_df, conc_df, thread_pool=None, workers=1):
+        key = id(temp_df)
+        if len(failed) < tanks and key not in failed and workers > 1:
+            failed.add(key)
+            fut = concurrent.futures.Future(); fut.set_exception(exc); return fut
+        return real(temp_df, conc_df, thread_pool, 1)
+    return submit
+
+
+def _events(**kw):
+    return list(analyse_plant(FACTORIES, PIClient(HTTPBasicAuth("u", "p")), START, END, **kw))
+
+
+def test_analysis_failure_is_an_error_event(fake_pi, clean_cache, monkeypatch):
+    monkeypatch.setattr(cip_data, "submit_cycle_index", _failing_submit(ValueError("bad frame"), 2))
+    ev = _events(analysis_workers=2)
+    errors  = [(tank, msg) for _, _, kind, _, tank, msg in ev if kind == "error"]
+    indexed = [tank for _, _, kind, _, tank, _ in ev if kind == "index"]
+    assert len(errors) == 2 and all(msg == "Analysis failed: bad frame" for _, msg in errors)
+    assert len(indexed) == len(FACTORIES["DC"]["tags"]) - 2
+    assert not {t for t, _ in errors} & set(indexed)
+    assert ev[-1][0] == ev[-1][1]   # done reaches total
+
+
+def test_broken_process_pool_is_retried_in_process(fake_pi, clean_cache, monkeypatch):
+    monkeypatch.setattr(cip_data, "submit_cycle_index", _failing_submit(BrokenProcessPool("worker died"), 3))
+    ev = _events(analysis_workers=2)
+    assert not [e for e in ev if e[2] == "error"]
+    indexed = {tank: payload[2] for _, _, kind, _, tank, payload in ev if kind == "index"}
+    assert set(indexed) == set(FACTORIES["DC"]["tags"]) and all(indexed.values())
+    assert ev[-1][0] == ev[-1][1]
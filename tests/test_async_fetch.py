@@ -0,0 +1,34 @@
+"""
+Async engine against FakePI — same frames as the thread engine, nothing heavy on the loop thread
+===============================================================================================
+"""
+
+import threading
+from datetime import date
+
+import pandas as pd
+from requests.auth import HTTPBasicAuth
+
+import cip_data
+from cip_data import AsyncPIClient, PIClient, get_data_pi, pi_event_loop
+
+TAG   = cip_data.FACTORY_CONFIG["DC"]["tags"]["R421"]
+START, END = date(2025, 12, 29), date(2025, 12, 31)
+
+
+def test_async_matches_thread_and_keeps_work_off_the_loop(fake_pi, clean_cache, monkeypatch):
+    auth = HTTPBasicAuth("u", "p")
+    ref  = get_data_pi(TAG, PIClient(auth), START, END)
+    cip_data.DISK_INDEX.remove(None); cip_data.SHARED_FRAMES.clear()
+
+    threads = {}
+    for name in ("_cache_plan", "_decode_items", "_save_day"):
+        fn = getattr(cip_data, name)
+        monkeypatch.setattr(cip_data, name, lambda *a, _fn=fn, _name=name, **kw:
+                            threads.setdefault(_name, set()).add(threading.current_thread().name) or _fn(*a, **kw))
+    monkeypatch.setattr(cip_data, "PI_PAGE_SIZE", 5000)   # several pages per gap
+
+    df = get_data_pi(TAG, AsyncPIClient(auth, pi_event_loop()), START, END)
+    pd.testing.assert_frame_equal(df, ref)
+    assert set(threads) == {"_cache_plan", "_decode_items", "_save_day"}
+    assert "cip-pi-loop" not in set().union(*threads.values())
@@ -0,0 +1,81 @@
+"""
+Batch mode against FakePI — fetch_batch returns what fetch_all_tags_parallel returns
+===================================================================================
+Covers the ParentIds WebId lookup, a full first page that is paged, and failed
+sub-requests that fall back to per-tag reads.
+"""
+
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+from requests.auth import HTTPBasicAuth
+
+import cip_data
+from cip_data import FACTORY_CONFIG, PIClient, fetch_all_tags_parallel, fetch_batch
+
+DC    = FACTORY_CONFIG["DC"]
+TAGS  = {**DC["tags"], "%CIP": DC["cip_tag"]}
+START, END = date(2025, 12, 29), date(2025, 12, 31)
+
+
+def _reset():
+    cip_data.DISK_INDEX.remove(None); cip_data.SHARED_FRAMES.clear()
+    os.remove(cip_data.WEBID_FILE)   # written by the reference client
+
+
+@pytest.fixture
+def reference(fake_pi, clean_cache):
+    frames, errors = fetch_all_tags_parallel(TAGS, PIClient(HTTPBasicAuth("u", "p")), START, END)
+    assert not errors and all(len(df) for df in frames.values())
+    _reset()
+    return frames
+
+
+def _assert_same(frames, errors, reference):
+    assert not errors and set(frames) == set(reference)
+    for name, df in frames.items():
+        pd.testing.assert_frame_equal(df.reset_index(drop=True), reference[name].reset_index(drop=True))
+
+
+def _fail_subrequests(fake_pi, monkeypatch, keys):
+    """FakePI /batch answering 500 for the given sub-request keys (409 for reads depending on them)"""
+    batch = fake_pi._batch
+    def failing(reqs):
+        out = batch(reqs)
+        for k in keys: out[k] = {"Status": 500, "Content": {}}
+        for k, r in reqs.items():
+            if set(r.get("ParentIds", ())) & set(keys): out[k] = {"Status": 409, "Content": {}}
+        return out
+    monkeypatch.setattr(fake_pi, "_batch", failing)
+
+
+def test_parent_id_lookup_in_one_call(fake_pi, reference):
+    client = PIClient(HTTPBasicAuth("u", "p"))
+    assert all(client.known_webid(t) is None for t in TAGS.values())
+    req0 = fake_pi.requests
+    frames, errors = fetch_batch(TAGS, client, START, END)
+    _assert_same(frames, errors, reference)
+    assert fake_pi.requests - req0 == 1
+    assert all(client.known_webid(t) == "W" + t for t in TAGS.values())
+
+
+def test_full_first_page_is_paged(fake_pi, reference, monkeypatch):
+    monkeypatch.setattr(cip_data, "PI_PAGE_SIZE", 10000)   # 3 days at 10 s = 25,920 points per tag
+    req0 = fake_pi.requests
+    frames, errors = fetch_batch(TAGS, PIClient(HTTPBasicAuth("u", "p")), START, END)
+    _assert_same(frames, errors, reference)
+    assert fake_pi.requests - req0 == 1 + 2 * len(TAGS)
+    assert all(df.attrs["pi_pages"] == 3 for df in frames.values())
+
+
+def test_failed_subrequests_fall_back(fake_pi, reference, monkeypatch):
+    # tag 0: its WebId lookup fails (the dependent read fails too); tag 1: only the read fails
+    _fail_subrequests(fake_pi, monkeypatch, ["w0", "r1_0"])
+    client = PIClient(HTTPBasicAuth("u", "p"))
+    req0 = fake_pi.requests
+    frames, errors = fetch_batch(TAGS, client, START, END)
+    _assert_same(frames, errors, reference)
+    assert fake_pi.requests - req0 == 1 + 2 + 1   # batch + (lookup + read) + read
+    assert all(client.known_webid(t) == "W" + t for t in TAGS.values())
@@ -0,0 +1,33 @@
+"""
+PI request limiting — one AIMD limiter for every engine in the process
+======================================================================
+"""
+
+import asyncio
+import threading
+
+from requests.auth import HTTPBasicAuth
+
+from cip_data import PI_LIMITER, AdaptiveLimiter, AsyncPIClient, PIClient, pi_event_loop
+
+
+def test_all_clients_share_the_process_limiter():
+    auth = HTTPBasicAuth("u", "p")
+    clients = [AsyncPIClient(auth, pi_event_loop()), AsyncPIClient(HTTPBasicAuth("v", "q"), pi_event_loop()),
+               PIClient(auth)]
+    assert all(c.limiter is PI_LIMITER for c in clients)
+
+
+def test_async_waiter_is_woken_by_a_thread_release():
+    lim = AdaptiveLimiter(start=1)
+    lim.acquire()   # a thread-engine request holds the only slot
+
+    async def main():
+        waiter = asyncio.ensure_future(lim.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        threading.Timer(0.05, lim.release, ("recorded", None, None)).start()
+        await asyncio.wait_for(waiter, 2)
+
+    asyncio.run(main())
+    assert lim.active == 1 and lim.limit == 1
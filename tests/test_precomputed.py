@@ -0,0 +1,39 @@
+"""
+Precomputed cycle indexes — a targeted cache clear invalidates the factories it touches
+======================================================================================
+"""
+
+from datetime import date
+
+from cip_data import FACTORY_CONFIG, drop_precomputed, load_precomputed, save_precomputed
+
+START, END = date(2025, 12, 1), date(2025, 12, 31)
+
+
+def _save(start, factories):
+    index  = {(f, t): [{"No": 1}] for f in factories for t in FACTORY_CONFIG[f]["tags"]}
+    errors = {f"{f}/%CIP": "HTTP 404" for f in factories}
+    save_precomputed(start, END, index, errors, factories)
+
+
+def test_tag_clear_drops_only_its_factory():
+    _save(START, ["DC", "PK1"]); _save(date(2025, 12, 2), ["DC"])
+    assert drop_precomputed([FACTORY_CONFIG["DC"]["tags"]["R421"]]) == 2
+    pre = load_precomputed(START, END)
+    assert pre["factories"] == ["PK1"]
+    assert {f for f, _ in pre["index"]} == {"PK1"} and list(pre["errors"]) == ["PK1/%CIP"]
+    assert load_precomputed(date(2025, 12, 2), END) is None
+
+
+def test_clear_of_an_unrelated_tag_keeps_results():
+    _save(START, ["DC"])
+    assert drop_precomputed([FACTORY_CONFIG["KN"]["tags"]["R421"]]) == 0
+    assert load_precomputed(START, END)["factories"] == ["DC"]
+    assert drop_precomputed([FACTORY_CONFIG["DC"]["cip_tag"]]) == 1   # %CIP tag counts too
+    assert load_precomputed(START, END) is None
+
+
+def test_clear_all():
+    _save(START, ["DC", "MCE"])
+    assert drop_precomputed(None) == 1
+    assert load_precomputed(START, END) is None
@@ -0,0 +1,29 @@
+"""
+PI retries — jittered backoff with the server's Retry-After as a hard floor
+===========================================================================
+"""
+
+import pytest
+from requests.auth import HTTPBasicAuth
+
+import cip_data
+from cip_data import PI_BACKOFF_MAX, PI_RETRY_AFTER_MAX, PIClient, PIRetryable, _backoff
+
+
+def test_retry_after_is_a_floor():
+    assert _backoff(1, 120) == 120   # used to be cut to PI_BACKOFF_MAX
+    assert all(0 <= _backoff(a) <= PI_BACKOFF_MAX for a in range(1, 10))
+    assert all(5 <= _backoff(1, 5) <= PI_BACKOFF_MAX for _ in range(20))
+
+
+@pytest.mark.parametrize("wait, sends", [(90, 3), (PI_RETRY_AFTER_MAX + 1, 1)])
+def test_long_retry_after_fails_instead_of_waiting(monkeypatch, wait, sends):
+    sent, slept = [], []
+    def send(*a, **kw):
+        sent.append(1); raise PIRetryable("429", "HTTP 429", wait)
+    client = PIClient(HTTPBasicAuth("u", "p"))
+    monkeypatch.setattr(client, "_send", send)
+    monkeypatch.setattr(cip_data.time, "sleep", slept.append)
+    with pytest.raises(PIRetryable):
+        client.get("/points", {}, 20, max_retries=3)
+    assert len(sent) == sends and slept == [wait] * (sends - 1)
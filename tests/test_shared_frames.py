@@ -0,0 +1,68 @@
+"""
+SharedFrameCache single-flight on the event loop
+================================================
+A waiter that gives up must not cancel the fetch it is waiting on, and a cancelled owner
+must hand its waiters an ordinary exception, not a CancelledError.
+"""
+
+import asyncio
+import concurrent.futures
+
+import pandas as pd
+import pytest
+
+from cip_data import SharedFrameCache
+
+KEY = ("TAG-1", None, None, True)
+
+
+def _frame():
+    return pd.DataFrame({'Time': pd.to_datetime(["2026-01-01 00:00"]), 'Val': [80.0]})
+
+
+def test_waiter_timeout_does_not_cancel_owner():
+    cache = SharedFrameCache(2**20)
+
+    async def slow():
+        await asyncio.sleep(0.2); return _frame()
+
+    async def main():
+        owner = asyncio.ensure_future(cache.aget(KEY, slow))
+        await asyncio.sleep(0)   # owner claims the key first
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(cache.aget(KEY, slow), 0.05)
+        late = asyncio.ensure_future(cache.aget(KEY, slow))
+        return await owner, await late
+
+    df, late = asyncio.run(main())
+    assert df['Val'].tolist() == [80.0] and late['Val'].tolist() == [80.0]
+    assert cache.misses == 1
+
+
+def test_cancelled_owner_gives_waiters_an_exception():
+    cache = SharedFrameCache(2**20)
+    state, fut = cache._claim(KEY)   # a sync caller's fetch in flight
+    assert state == "own"
+
+    async def never():
+        await asyncio.sleep(10)
+
+    async def main():
+        waiter = asyncio.ensure_future(cache.aget(KEY, never))
+        await asyncio.sleep(0)
+        cache._settle(KEY, fut, error=asyncio.CancelledError())
+        with pytest.raises(RuntimeError, match="cancelled"):
+            await waiter
+
+    asyncio.run(main())
+    assert isinstance(fut.exception(), Exception)
+
+
+def test_settle_skips_a_cancelled_future():
+    cache = SharedFrameCache(2**20)
+    _, fut = cache._claim(KEY)
+    fut.cancel()
+    cache._settle(KEY, fut, _frame())   # used to raise InvalidStateError
+    assert cache.peek(KEY)['Val'].tolist() == [80.0]
+    with pytest.raises(concurrent.futures.CancelledError):
+        fut.result()